@@ -0,0 +1,119 @@
+"""
+Historical backtest of the DCF model over the fiscal years stored in financial_data.
+Every (ticker, fiscal year) row is valued with only the data of that fiscal year, the way run_dcf values the latest year,
+and its margin of safety is compared with the share price at the later fiscal dates of the same ticker.
+The whole panel is valued in one batched pass and the later prices are looked up with integer keys, without loops.
+Shares outstanding and beta come from yfinance's info and are only known as of today, so they are used for every year;
+the market cap is recomputed from each year's share price so that the WACC weights are point-in-time.
+"""
+from scripts.dcf_model import value_arrays, INPUT_COLUMNS, YEAR_KEY_BASE
+from scripts.instrumentation import timed, stage
+
+import numpy as np
+import pandas as pd
+
+QUANTILES = 5   # Number of margin of safety buckets per fiscal year in the quantile table
+
+
+@timed('backtest')
+def run_backtest(df, growth_rate, discount_rate, terminal_growth, years, horizons, threshold=0.0):
+    """
+    Values every ticker as of every stored fiscal year and measures the returns that followed.
+    :param df: DataFrame with the full financial data history indexed by ticker then year
+    :param growth_rate: Annual growth rate for projected free cash flows
+    :param discount_rate: Discount rate for DCF calculations
+    :param terminal_growth: Terminal growth rate for calculating terminal value
+    :param years: Number of years to project free cash flows
+    :param horizons: Numbers of years after the fiscal year at which the realized return is measured
+    :param threshold: Margin of safety (in percent) above which a ticker counts as undervalued
+    :return: Tuple of (panel DataFrame indexed by ticker and year with the valuation and the return per horizon,
+        summary DataFrame indexed by horizon, DataFrame of mean returns per margin of safety quantile and horizon)
+    """
+    print(f"Backtesting {len(df)} ticker years...")
+
+    tickers = df.index.get_level_values('ticker').to_numpy()
+    fiscal_years = df.index.get_level_values('year').to_numpy(dtype=np.int64)
+    arrays = {col: pd.to_numeric(df[col], errors='coerce').to_numpy(dtype=float) for col in INPUT_COLUMNS}
+    arrays['market_cap'] = arrays['share_price'] * arrays['shares_outstanding']     # Market cap at the fiscal date
+    with stage('backtest.value'):
+        values = value_arrays(arrays, growth_rate, discount_rate, terminal_growth, years)
+
+    panel = pd.DataFrame({
+        'share_price': arrays['share_price'],
+        'estimated_price': values['estimated_price'],
+        'margin_of_safety': values['margin_of_safety'],
+    }, index=df.index)
+    for horizon in horizons:
+        panel[f'return_{horizon}y'] = forward_returns(tickers, fiscal_years, arrays['share_price'], horizon)
+
+    return panel, backtest_summary(panel, horizons, threshold), quantile_returns(panel, horizons)
+
+def forward_returns(tickers, fiscal_years, share_price, horizon):
+    """
+    Returns the share price return from each fiscal date to the fiscal date `horizon` years later of the same ticker.
+    :param tickers: Array with the ticker of every row
+    :param fiscal_years: Array with the fiscal year of every row
+    :param share_price: Array with the share price at every row's fiscal date
+    :param horizon: Number of fiscal years ahead
+    :return: Array of returns, NaN where the later fiscal year is not stored
+    """
+    codes, _ = pd.factorize(tickers)
+    keys = codes.astype(np.int64) * YEAR_KEY_BASE + fiscal_years
+    later = pd.Index(keys).get_indexer(keys + horizon)  # Row of the same ticker `horizon` years later, -1 if missing
+    later_price = np.where(later >= 0, share_price[later], np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return later_price / share_price - 1
+
+def backtest_summary(panel, horizons, threshold=0.0):
+    """
+    Summarizes how well the margin of safety predicted the later returns.
+    The hit rate is the share of valuations whose sign (undervalued or overvalued) matched the sign of the return.
+    Rows with an estimated price of zero or below (negative free cash flow) have a meaningless margin of safety,
+    which is large and positive for a negative estimate, so they are left out and counted in 'excluded_non_positive'.
+    :param panel: Panel DataFrame from run_backtest
+    :param horizons: Horizons with a return column in the panel
+    :param threshold: Margin of safety (in percent) above which a ticker counts as undervalued
+    :return: DataFrame indexed by horizon
+    """
+    margin = panel['margin_of_safety'].to_numpy()
+    positive = panel['estimated_price'].to_numpy() > 0
+    rows = []
+    for horizon in horizons:
+        returns = panel[f'return_{horizon}y'].to_numpy()
+        measured = np.isfinite(margin) & np.isfinite(returns)
+        valid = measured & positive
+        undervalued = valid & (margin > threshold)
+        overvalued = valid & ~(margin > threshold)
+        with np.errstate(invalid='ignore'):
+            rows.append({
+                'horizon': horizon,
+                'observations': int(valid.sum()),
+                'excluded_non_positive': int((measured & ~positive).sum()),
+                'undervalued': int(undervalued.sum()),
+                'hit_rate': np.mean((returns[valid] > 0) == (margin[valid] > threshold)) if valid.any() else np.nan,
+                'undervalued_hit_rate': np.mean(returns[undervalued] > 0) if undervalued.any() else np.nan,
+                'mean_return_undervalued': np.mean(returns[undervalued]) if undervalued.any() else np.nan,
+                'mean_return_overvalued': np.mean(returns[overvalued]) if overvalued.any() else np.nan,
+                'median_return_undervalued': np.median(returns[undervalued]) if undervalued.any() else np.nan,
+                'mean_return_all': np.mean(returns[valid]) if valid.any() else np.nan,
+                'rank_correlation': pd.Series(margin[valid]).rank().corr(pd.Series(returns[valid]).rank()),    # Spearman, without scipy
+            })
+    return pd.DataFrame(rows).set_index('horizon')
+
+def quantile_returns(panel, horizons, quantiles=QUANTILES):
+    """
+    Returns the mean return per margin of safety quantile, with the quantiles formed within each fiscal year.
+    Rows with an estimated price of zero or below are left out, as in backtest_summary.
+    :param panel: Panel DataFrame from run_backtest
+    :param horizons: Horizons with a return column in the panel
+    :param quantiles: Number of quantiles (1 holds the lowest margins of safety)
+    :return: DataFrame indexed by quantile with one column of mean returns per horizon
+    """
+    margin = panel['margin_of_safety'].where(np.isfinite(panel['margin_of_safety']) & (panel['estimated_price'] > 0))
+    by_year = margin.groupby(level='year')
+    rank = by_year.rank(method='first')     # 1..n within the fiscal year, NaN margins stay unranked
+    count = by_year.transform('count')
+    quantile = (np.floor((rank - 1) * quantiles / count) + 1).astype('Int64').rename('quantile')    # Equal sized buckets, the lowest margin is always in 1
+    columns = [f'return_{horizon}y' for horizon in horizons]
+    returns = panel[columns].where(np.isfinite(panel[columns]))
+    return returns.groupby(quantile).mean()
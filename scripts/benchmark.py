@@ -0,0 +1,322 @@
+"""
+Benchmarks for the DCF pipeline on synthetic ticker universes, without network access.
+Run from the repository root, e.g. `python -m scripts.benchmark stages --sizes 10 100 1000 --output bench.json`.
+Results are written as JSON so that regressions can be tracked between versions.
+"""
+from scripts.db_manager import (init_db, upsert_data, insert_data, read_financial_data, get_stale_tickers,
+                                update_ticker_status)
+from scripts.dcf_model import run_dcf, run_monte_carlo, calculate_wacc_batch, latest_arrays, value_arrays, map_shards
+from scripts.fetch_data import fetch_ticker_payload, parse_payloads
+from scripts.synthetic import make_financial_data, make_tickers, FakeTicker, LAST_FISCAL_YEAR
+from scripts.storage import SQLiteBackend, DuckDBBackend
+from scripts.server import ValuationStore, make_server
+from scripts.config import (GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS, RISK_FREE_RETURN, MARKET_RETURN, REFRESH_DAYS,
+                            MONTE_CARLO_DISTRIBUTIONS)
+
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from time import perf_counter
+import urllib.request
+import subprocess
+import threading
+import platform
+import sys
+import argparse
+import tempfile
+import json
+import numpy as np
+import io
+import os
+
+STAGE_SIZES = (10, 100, 1_000, 10_000, 100_000)     # Number of tickers per stage benchmark
+FETCH_MAX_TICKERS = 1_000     # Largest universe for the parse stage, whose payloads are fetched from fake tickers first
+UPSERT_SIZES = (10_000, 100_000, 1_000_000)    # Number of rows per upsert benchmark
+STORAGE_SIZES = (1_000_000, 3_000_000)     # Number of financial_data rows per storage benchmark
+STORAGE_YEARS = 20  # Years of history per ticker in the storage benchmark
+SERVER_SIZES = (1_000, 100_000)    # Number of tickers loaded per server benchmark
+SERVER_REQUESTS = 2_000     # Single-ticker valuation requests per server benchmark
+WORKER_SIZES = (20_000, 200_000)    # Number of tickers per worker scaling benchmark
+WORKER_COUNTS = (1, 2, 4)   # Numbers of worker processes compared in the worker scaling benchmark
+WORKER_SAMPLES = 10_000     # Monte Carlo samples per ticker in the worker scaling benchmark
+STORAGE_QUERIES = {     # Analytical queries run on every storage backend, with ? placeholders
+    'scan': ("SELECT COUNT(*) AS n, SUM(fcf) AS fcf, AVG(market_cap) AS market_cap FROM financial_data", ()),
+    'per_year': ("""SELECT year, COUNT(*) AS n, AVG(fcf) AS fcf, AVG(fcf / market_cap) AS fcf_yield
+                    FROM financial_data GROUP BY year ORDER BY year""", ()),
+    'screen': ("""SELECT ticker, fcf / market_cap AS fcf_yield FROM financial_data
+                  WHERE year = ? AND fcf > 0 ORDER BY fcf_yield DESC LIMIT 100""", (LAST_FISCAL_YEAR,)),
+    'dcf_per_year': ("""SELECT year, SUM(discounted_fcf) AS discounted_fcf, COUNT(*) AS n
+                        FROM dcf_table GROUP BY year ORDER BY year""", ()),
+}
+
+
+def benchmark_stages(sizes=STAGE_SIZES, repeat=3, fetch_max_tickers=FETCH_MAX_TICKERS):
+    """
+    Times every stage of the pipeline separately on synthetic universes.
+    Each stage is run `repeat` times and the fastest time is reported.
+    :param sizes: Numbers of tickers
+    :param repeat: Number of runs per stage
+    :param fetch_max_tickers: Largest universe for which the parse_payloads stage is timed
+    :return: List of dictionaries with the tickers, stage, seconds and microseconds per ticker
+    """
+    results = []
+    for n_tickers in sizes:
+        df = make_financial_data(n_tickers)
+        tickers = make_tickers(n_tickers)
+
+        def record(stage, func):
+            seconds = min(_time(func) for _ in range(repeat))
+            results.append({'tickers': n_tickers, 'stage': stage, 'seconds': seconds,
+                            'us_per_ticker': seconds / n_tickers * 1e6})
+            print(f"{n_tickers:>7} tickers  {stage:<20} {seconds:>9.4f} s", flush=True)
+
+        if n_tickers <= fetch_max_tickers:   # Parsing only: the fake tickers are requested once, outside the timing
+            payloads = [fetch_ticker_payload(ticker, ticker_factory=FakeTicker) for ticker in tickers]
+            record('parse_payloads', lambda: parse_payloads(payloads))
+        _, arrays = latest_arrays(df)
+        record('calculate_wacc', lambda: calculate_wacc_batch(arrays, RISK_FREE_RETURN, MARKET_RETURN, DISCOUNT_RATE))
+        record('run_dcf', lambda: run_dcf(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS))
+        dcf_df, _ = _quiet(lambda: run_dcf(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = _quiet(lambda: init_db(os.path.join(tmp_dir, "benchmark.db")))
+            record('upsert_data', lambda: upsert_data(engine, df, 'financial_data', ['ticker', 'year']))
+            record('insert_data', lambda: insert_data(engine, dcf_df, 'dcf_table'))
+            update_ticker_status(engine, tickers, 'financial_data')
+
+            def cached_read():    # The cached path of main: freshness check and read of the stored data
+                get_stale_tickers(engine, tickers, 'financial_data', REFRESH_DAYS)
+                return read_financial_data(engine, tickers, latest_only=True)
+            record('cached_read', cached_read)
+            engine.dispose()
+    return results
+
+
+def benchmark_upsert(sizes=UPSERT_SIZES, chunk_size=None, fast_load=None):
+    """
+    Measures upsert_data throughput into a fresh SQLite database, first as inserts and then as updates of the same rows.
+    :param sizes: Numbers of rows to upsert
+    :param chunk_size: Number of rows per executemany batch (default UPSERT_CHUNK_SIZE)
+    :param fast_load: If True, use WAL mode and synchronous=NORMAL (default SQLITE_FAST_LOAD)
+    :return: List of dictionaries with the rows and rows/sec for inserts and updates
+    """
+    results = []
+    for n_rows in sizes:
+        df = make_financial_data(-(-n_rows // 10), years_per_ticker=10).iloc[:n_rows]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = _quiet(lambda: init_db(os.path.join(tmp_dir, "benchmark.db")))
+            insert_seconds = _time(lambda: upsert_data(engine, df, 'financial_data', ['ticker', 'year'], chunk_size, fast_load))  # All rows are new
+            update_seconds = _time(lambda: upsert_data(engine, df, 'financial_data', ['ticker', 'year'], chunk_size, fast_load))  # All rows conflict
+            engine.dispose()
+
+        result = {'rows': n_rows, 'insert_rows_per_sec': n_rows / insert_seconds,
+                  'update_rows_per_sec': n_rows / update_seconds}
+        print(f"upsert {n_rows:>9,} rows: {result['insert_rows_per_sec']:>10,.0f} rows/s insert, "
+              f"{result['update_rows_per_sec']:>10,.0f} rows/s update", flush=True)
+        results.append(result)
+    return results
+
+
+def benchmark_storage(sizes=STORAGE_SIZES, repeat=3, years=STORAGE_YEARS):
+    """
+    Compares scan and aggregation latency of the storage backends on a multi-year financial_data history
+    and its dcf_table. Each query is run `repeat` times and the fastest time is reported.
+    :param sizes: Numbers of financial_data rows
+    :param repeat: Number of runs per query
+    :param years: Years of history per ticker
+    :return: List of dictionaries with the rows, backend, query (or 'load') and seconds
+    """
+    results = []
+    for n_rows in sizes:
+        df = make_financial_data(-(-n_rows // years), years_per_ticker=years).iloc[:n_rows]
+        dcf_df, _ = _quiet(lambda: run_dcf(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            backends = {'sqlite': lambda: SQLiteBackend(os.path.join(tmp_dir, "benchmark.db")),
+                        'duckdb': lambda: DuckDBBackend(os.path.join(tmp_dir, "benchmark.duckdb"))}
+            for name, open_backend in backends.items():
+                backend = _quiet(open_backend)
+
+                def load():
+                    backend.upsert(df, 'financial_data', ['ticker', 'year'])
+                    backend.upsert(dcf_df, 'dcf_table', ['ticker', 'year'])
+                runs = [('load', _time(load))]   # Loaded once, into an empty database
+                for query, (sql, params) in STORAGE_QUERIES.items():
+                    runs.append((query, min(_time(lambda: backend.query(sql, params)) for _ in range(repeat))))
+                backend.close()
+
+                for query, seconds in runs:
+                    results.append({'rows': n_rows, 'backend': name, 'query': query, 'seconds': seconds})
+                    print(f"{n_rows:>9,} rows  {name:<7} {query:<13} {seconds:>9.4f} s", flush=True)
+    return results
+
+
+def benchmark_server(sizes=SERVER_SIZES, requests=SERVER_REQUESTS, seed=0):
+    """
+    Measures the latency of single-ticker valuations over the HTTP API of the valuation server, with random tickers
+    and growth rates so that both memoized and new valuations are requested.
+    :param sizes: Numbers of tickers loaded into the server
+    :param requests: Number of requests per size, sent one at a time
+    :param seed: Seed for the random tickers and growth rates
+    :return: List of dictionaries with the tickers, load seconds and p50/p99/max latency in milliseconds
+    """
+    results = []
+    rng = np.random.default_rng(seed)
+    for n_tickers in sizes:
+        df = make_financial_data(n_tickers)
+        tickers = make_tickers(n_tickers)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = _quiet(lambda: init_db(os.path.join(tmp_dir, "benchmark.db")))
+            upsert_data(engine, df, 'financial_data', ['ticker', 'year'])
+            start = perf_counter()
+            store = _quiet(lambda: ValuationStore(engine, tickers))
+            load_seconds = perf_counter() - start
+            server = make_server(store, '127.0.0.1', 0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            base = f"http://127.0.0.1:{server.server_address[1]}/value"
+            latency = np.empty(requests)
+            for i in range(requests):
+                url = f"{base}?ticker={tickers[rng.integers(n_tickers)]}&growth_rate={rng.integers(11) / 100}"
+                start = perf_counter()
+                with urllib.request.urlopen(url) as response:
+                    response.read()
+                latency[i] = perf_counter() - start
+            server.shutdown()
+            server.server_close()
+            engine.dispose()
+
+        p50, p99 = np.percentile(latency, [50, 99]) * 1000
+        result = {'tickers': n_tickers, 'load_seconds': load_seconds, 'p50_ms': p50, 'p99_ms': p99,
+                  'max_ms': latency.max() * 1000}
+        print(f"{n_tickers:>7} tickers  load {load_seconds:.3f} s  p50 {p50:.2f} ms  p99 {p99:.2f} ms", flush=True)
+        results.append(result)
+    return results
+
+
+def benchmark_workers(sizes=WORKER_SIZES, worker_counts=WORKER_COUNTS, repeat=3, samples=WORKER_SAMPLES):
+    """
+    Measures throughput against the number of worker processes for the single-pass valuation (value_arrays) and the
+    Monte Carlo simulation. Every pool is started and used once before it is timed, as map_shards reuses its pools.
+    :param sizes: Numbers of tickers
+    :param worker_counts: Numbers of worker processes
+    :param repeat: Number of runs per measurement, the fastest is reported
+    :param samples: Monte Carlo samples per ticker
+    :return: List of dictionaries with the tickers, stage, workers, seconds and tickers per second
+    """
+    results = []
+    for n_tickers in sizes:
+        df = make_financial_data(n_tickers)
+        _, arrays = latest_arrays(df)
+        stages = {
+            'value_arrays': lambda workers: map_shards(value_arrays, arrays, workers, GROWTH_RATE, DISCOUNT_RATE,
+                                                       TERMINAL_GROWTH, YEARS),
+            'monte_carlo': lambda workers: run_monte_carlo(df, samples, MONTE_CARLO_DISTRIBUTIONS, YEARS, DISCOUNT_RATE,
+                                                           seed=0, workers=workers),
+        }
+        for stage, func in stages.items():
+            for workers in worker_counts:
+                _quiet(lambda: func(workers))   # Starts the pool outside the timing
+                seconds = min(_time(lambda: func(workers)) for _ in range(repeat))
+                results.append({'tickers': n_tickers, 'stage': stage, 'workers': workers, 'seconds': seconds,
+                                'tickers_per_sec': n_tickers / seconds})
+                print(f"{n_tickers:>7} tickers  {stage:<13} {workers} workers {seconds:>9.4f} s", flush=True)
+    return results
+
+
+def measure_import_time(module='scripts.main', repeat=3):
+    """
+    Measures the time to import a module in a fresh interpreter with `python -X importtime`.
+    :param module: Name of the module to import
+    :param repeat: Number of interpreters started, the fastest import is reported
+    :return: Tuple of (seconds to import the module, dictionary mapping every imported module to its cumulative seconds)
+    """
+    runs = []
+    for _ in range(repeat):
+        stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                check=True).stderr
+        modules = {}
+        for line in stderr.splitlines():    # "import time: self [us] | cumulative | imported package"
+            if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+                _, cumulative, name = line.split("|")
+                modules[name.strip()] = int(cumulative) / 1e6
+        runs.append((modules[module], modules))
+    return min(runs, key=lambda run: run[0])
+
+
+def write_report(benchmark, results, output=None):
+    """
+    Writes benchmark results as JSON together with the version and environment they were measured on.
+    :param benchmark: Name of the benchmark
+    :param results: List of result dictionaries
+    :param output: Path of the JSON file (default print to stdout)
+    :return: The report dictionary
+    """
+    report = {
+        'benchmark': benchmark,
+        'version': _git_version(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {output}")
+    return report
+
+
+def _time(func):
+    """
+    Returns the wall-clock seconds of one call of func, with its progress output suppressed.
+    """
+    start = perf_counter()
+    _quiet(func)
+    return perf_counter() - start
+
+
+def _quiet(func):
+    """
+    Calls func with its progress output (print statements) suppressed.
+    """
+    with redirect_stdout(io.StringIO()):
+        return func()
+
+
+def _git_version():
+    """
+    Returns the current git commit of the repository, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks on synthetic ticker universes")
+    parser.add_argument('benchmark', nargs='?', choices=['stages', 'upsert', 'storage', 'server', 'workers', 'imports'],
+                        default='stages')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None, help="Tickers (stages, server, workers) or rows (upsert, storage)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per stage, the fastest is reported")
+    parser.add_argument('--output', default=None, help="JSON file for the results (default stdout)")
+    args = parser.parse_args()
+
+    if args.benchmark == 'upsert':
+        results = benchmark_upsert(args.sizes or UPSERT_SIZES)
+    elif args.benchmark == 'imports':
+        seconds, modules = measure_import_time()
+        results = [{'module': name, 'seconds': seconds} for name, seconds in modules.items() if '.' not in name]
+        print(f"import scripts.main: {seconds:.3f} s")
+    elif args.benchmark == 'server':
+        results = benchmark_server(args.sizes or SERVER_SIZES)
+    elif args.benchmark == 'workers':
+        results = benchmark_workers(args.sizes or WORKER_SIZES, repeat=args.repeat)
+    elif args.benchmark == 'storage':
+        results = benchmark_storage(args.sizes or STORAGE_SIZES, args.repeat)
+    else:
+        results = benchmark_stages(args.sizes or STAGE_SIZES, args.repeat)
+    write_report(args.benchmark, results, args.output)
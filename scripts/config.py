@@ -2,6 +2,9 @@
 Configuration file for the DCF analysis script.
 This file contains constants and configurations used throughout the script.
 """
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # Repository root, file locations below are relative to it
 
 TICKERS = ['BALD-B.ST', 'CORE-B.ST', 'SAGA-B.ST', 'CAST.ST']    # List of tickers to analyze
 REFRESH_DAYS = 7    # Number of days to refresh data
@@ -14,9 +17,77 @@ YEARS = 5   # Number of years to project free cash flows
 RISK_FREE_RETURN = 0.025    # 2.5% risk-free return (e.g., from government bonds)
 MARKET_RETURN = 0.08    # 8% expected market return (e.g., from stock market index)
 
+# Multi-stage DCF with a time-varying discount rate (python -m scripts.main staged)
+STAGED_YEARS = 10           # Number of years to project free cash flows
+HIGH_GROWTH_YEARS = 5       # Years of GROWTH_RATE before the fade
+FADE_YEARS = 3              # Years over which growth fades linearly to STABLE_GROWTH (0 for a two-stage model)
+STABLE_GROWTH = 0.03        # Growth after the fade until the end of the projection
+RISK_FREE_CURVE = [RISK_FREE_RETURN]    # Risk-free rate per projected year for the WACC, the last rate is used for later years
+MID_YEAR = False            # Discount the cash flows of each year from the middle of the year
+
+# Historical backtest (python -m scripts.main backtest)
+BACKTEST_HORIZONS = (1, 3)  # Years after each fiscal year at which the realized return is measured
+BACKTEST_THRESHOLD = 0.0    # Margin of safety (%) above which a ticker counts as undervalued
+
+# Streaming pipeline
+PIPELINE_BATCH_SIZE = 500   # Number of tickers fetched, valued and written per batch
+
+# Parallel Monte Carlo simulation: tickers are split into shards simulated in separate processes
+VALUATION_WORKERS = 1       # Number of worker processes for the Monte Carlo simulation (1 runs in the main process)
+VALUATION_MIN_SHARD = 1000  # Minimum number of tickers per shard, smaller universes use fewer workers
+
+# Report output
+PLOT_FILE = os.path.join(ROOT_DIR, "data", "dcf_plot.png")     # Plot file written by --headless runs without --plot-file
+IMPORT_TIME_BUDGET = 1.0    # Maximum seconds to import scripts.main, checked by main.test()
+
+# Valuation server (python -m scripts.main serve)
+SERVER_HOST = '127.0.0.1'   # Interface the HTTP API listens on, local only by default
+SERVER_PORT = 8050          # Port of the HTTP API
+SERVER_CACHE_SIZE = 100000  # Number of memoized (ticker, assumptions) valuations
+SERVER_MAX_YEARS = 100      # Largest projection a request may ask for, a valuation allocates one column per year
+
+# Monte Carlo valuation: distributions as (numpy Generator method, *parameters)
+MONTE_CARLO_SAMPLES = 100000    # Number of samples per ticker
+MONTE_CARLO_DISTRIBUTIONS = {
+    'growth_rate': ('normal', GROWTH_RATE, 0.02),           # Annual growth rate for projected free cash flows
+    'terminal_growth': ('uniform', 0.01, 0.03),             # Terminal growth rate
+    'discount_spread': ('normal', 0.0, 0.01),               # Shock added to each ticker's WACC (floored at 8%)
+}
+
+# Sensitivity grid: (start, stop, number of points) or a list of values per assumption
+SENSITIVITY_GRID = {
+    'growth_rate': (0.0, 0.10, 11),
+    'discount_rate': (0.06, 0.14, 9),
+    'terminal_growth': (0.01, 0.03, 5),
+    'years': [5],
+}
+
 # Database file location
-DB_PATH = r"../db/dcf.db"    # Main database file for DCF analysis
-TEST_DB_PATH = r"../db/test_dcf.db"     # Test database file for DCF analysis
+DB_PATH = os.path.join(ROOT_DIR, "db", "dcf.db")    # Main database file for DCF analysis
+TEST_DB_PATH = os.path.join(ROOT_DIR, "db", "test_dcf.db")    # Test database file for DCF analysis
+UPSERT_CHUNK_SIZE = 10000   # Number of rows written per executemany batch
+SQLITE_FAST_LOAD = True     # Use WAL journal mode and synchronous=NORMAL during bulk loads
+DUCKDB_PATH = os.path.join(ROOT_DIR, "db", "dcf.duckdb")    # DuckDB file the columnar backend and `main export` write to
+
+# Configuration for concurrent fetching from yfinance
+FETCH_WORKERS = 8       # Number of tickers fetched in parallel (1 fetches tickers one at a time)
+FETCH_TIMEOUT = 30      # Seconds before a single yfinance request is abandoned and retried (0 for no timeout)
+FETCH_RETRIES = 3       # Number of retries for a failed or timed out request
+FETCH_BACKOFF = 1.0     # Base delay in seconds for the exponential backoff between retries
+FETCH_RATE_LIMIT = 5    # Maximum number of yfinance requests started per second (0 for no limit)
+PRICE_WINDOW_DAYS = 5   # Days before and after a fiscal date to look for the closing share price
+
+# Local cache of raw yfinance responses
+CACHE_DIR = os.path.join(ROOT_DIR, "cache")    # Directory for cached yfinance responses
+CACHE_MAX_MB = 500          # Maximum size of the cache before least recently used entries are evicted
+CACHE_OFFLINE = False       # Serve cached responses whatever their age (also --offline), for reproducible runs from the cache
+CACHE_TTL_DAYS = {          # Number of days a cached response stays fresh, per category
+    'info': 1,
+    'cashflow': 30,
+    'balancesheet': 30,
+    'financials': 30,
+    'share_price': 365,
+}
 
 # Configuration for fetching financial data from yfinance
 FETCH_CONFIG = {
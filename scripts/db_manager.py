@@ -1,7 +1,14 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, Float, MetaData, DateTime, text, inspect, select
-from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy import create_engine, Table, Column, Integer, String, Float, MetaData, DateTime, Index, text, inspect, select
 from datetime import datetime, timezone, timedelta
+from scripts.config import UPSERT_CHUNK_SIZE, SQLITE_FAST_LOAD
+from scripts.instrumentation import timed, increment
 import pandas as pd
+import numpy as np
+import os
+
+RESULT_COLUMNS = ["share_price", "estimated_price", "margin_of_safety"]    # Columns compared to detect changed valuations
+SELECTED_TICKERS = "selected_tickers"   # Temporary table holding the tickers a query is filtered on
+_table_cache = {}   # Reflected tables keyed by (database url, table name)
 
 def init_db(db_path):
     """
@@ -11,6 +18,7 @@ def init_db(db_path):
     """
     print("Initializing database...")
 
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)     # The db directory is not part of the repository
     engine = create_engine(f"sqlite:///{db_path}")  # SQLite database connection
     metadata = MetaData()   # Metadata object to hold table definitions
 
@@ -28,6 +36,7 @@ def init_db(db_path):
         Column("market_cap", Float),
         Column("beta", Float),
         Column("share_price", Float),
+        Index("ix_financial_data_year", "year")     # Cross-sectional queries over all tickers of a year
     )
 
     # Table 2: DCF
@@ -42,7 +51,7 @@ def init_db(db_path):
         Column("discounted_tv", Float),
     )
 
-    # Table 3: Results
+    # Table 3: Results (latest valuation per ticker)
     results_table = Table(
         "results_table",
         metadata,
@@ -53,6 +62,92 @@ def init_db(db_path):
         Column("margin_of_safety", Float)
     )
 
+    # Table 4: Valuation runs and the assumptions they used
+    valuation_runs = Table(
+        "valuation_runs",
+        metadata,
+        Column("run_id", String, primary_key=True),
+        Column("date", DateTime),
+        Column("growth_rate", Float),
+        Column("discount_rate", Float),
+        Column("terminal_growth", Float),
+        Column("years", Integer),
+        Column("risk_free_return", Float),
+        Column("market_return", Float)
+    )
+
+    # Table 5: Results history (append-only, a row per run for every ticker whose valuation changed)
+    results_history = Table(
+        "results_history",
+        metadata,
+        Column("run_id", String, primary_key=True),
+        Column("ticker", String, primary_key=True),
+        Column("date", DateTime),
+        Column("share_price", Float),
+        Column("estimated_price", Float),
+        Column("margin_of_safety", Float),
+        Index("ix_results_history_ticker_date", "ticker", "date"),
+        Index("ix_results_history_date", "date")
+    )
+
+    # Table 6: Monte Carlo results (percentiles of the estimated price per run and ticker)
+    simulation_results = Table(
+        "simulation_results",
+        metadata,
+        Column("run_id", String, primary_key=True),
+        Column("ticker", String, primary_key=True),
+        Column("date", DateTime),
+        Column("share_price", Float),
+        Column("n_samples", Integer),
+        Column("mean_price", Float),
+        Column("p5_price", Float),
+        Column("p25_price", Float),
+        Column("p50_price", Float),
+        Column("p75_price", Float),
+        Column("p95_price", Float),
+        Column("prob_positive_mos", Float),
+        Index("ix_simulation_results_ticker", "ticker")
+    )
+
+    # Fingerprint of the inputs and assumptions of each ticker's stored result, unchanged tickers are not revalued
+    valuation_fingerprints = Table(
+        "valuation_fingerprints",
+        metadata,
+        Column("ticker", String, primary_key=True),
+        Column("fingerprint", Integer),
+        Column("run_id", String)
+    )
+
+    # Table 7: Sensitivity grid (estimated price per run, ticker and scenario)
+    sensitivity_grid = Table(
+        "sensitivity_grid",
+        metadata,
+        Column("run_id", String, primary_key=True),
+        Column("ticker", String, primary_key=True),
+        Column("growth_rate", Float, primary_key=True),
+        Column("discount_rate", Float, primary_key=True),
+        Column("terminal_growth", Float, primary_key=True),
+        Column("years", Integer, primary_key=True),
+        Column("estimated_price", Float),
+        Column("margin_of_safety", Float),
+        Index("ix_sensitivity_grid_ticker", "ticker")
+    )
+
+    # Checkpoints of streaming runs: a run is resumable until it is finished, completed tickers are skipped
+    pipeline_runs = Table(
+        "pipeline_runs",
+        metadata,
+        Column("run_id", String, primary_key=True),
+        Column("started", DateTime),
+        Column("finished", DateTime)
+    )
+    run_progress = Table(
+        "run_progress",
+        metadata,
+        Column("run_id", String, primary_key=True),
+        Column("ticker", String, primary_key=True)
+    )
+
     # Metadata table
     data_status = Table(
         "data_status",
@@ -61,11 +156,43 @@ def init_db(db_path):
         Column("last_updated", DateTime)
     )
 
+    # Metadata table: last update per ticker and category (e.g. 'financial_data')
+    ticker_status = Table(
+        "ticker_status",
+        metadata,
+        Column("ticker", String, primary_key=True),
+        Column("category", String, primary_key=True),
+        Column("last_updated", DateTime)
+    )
+
+    # Derived tables used to be rewritten with to_sql, which dropped their primary keys. They are recomputed on every run.
+    drop_tables_without_primary_key(engine, ["dcf_table", "results_table"])
     metadata.create_all(engine)
+    for table in metadata.sorted_tables:    # create_all skips the indexes of tables that already exist
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
     return engine
 
+def drop_tables_without_primary_key(engine, table_names):
+    """
+    Drops the given tables if they exist without a primary key, so that init_db can recreate them with their declared schema.
+    :param engine: SQLAlchemy engine object
+    :param table_names: Names of the tables to check
+    :return: None
+    """
+    inspector = inspect(engine)
+    existing = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table_name in table_names:
+            if table_name in existing and not inspector.get_pk_constraint(table_name)["constrained_columns"]:
+                print(f"Recreating table without primary key: {table_name}")
+                conn.exec_driver_sql(f'DROP TABLE "{table_name}"')
+                _table_cache.pop((str(engine.url), table_name), None)
+    return
+
 # TODO: - Add error handling for database operations
+@timed('db.insert')
 def insert_data(engine, df, table_name):
     """
     Insert data into the database table.
@@ -76,30 +203,346 @@ def insert_data(engine, df, table_name):
     """
     print(f"inserting data in table: {table_name}")
     df.to_sql(name=table_name, con=engine, if_exists='replace', index=True)   # Replace existing table with new data
+    increment('rows_written', len(df))
+    _table_cache.pop((str(engine.url), table_name), None)     # The table was recreated, drop its cached definition
     return
 
-def upsert_data(engine, df, table_name, keys):
+@timed('db.upsert')
+def upsert_data(engine, df, table_name, keys, chunk_size=None, fast_load=None):
     """
     Upsert data into the database table, updating existing rows based on specified keys.
+    Rows are written in chunks through one prepared statement with executemany, which keeps memory bounded
+    and stays below SQLite's bound-parameter limit.
     :param engine: SQLAlchemy engine object
     :param df: DataFrame containing the data to upsert
     :param table_name: Name of the table to upsert data into
     :param keys: List of column names to use as keys for upserting
-    :return:
+    :param chunk_size: Number of rows per executemany batch (default UPSERT_CHUNK_SIZE)
+    :param fast_load: If True, switch SQLite to WAL mode and synchronous=NORMAL for the load (default SQLITE_FAST_LOAD)
+    :return: Number of rows written
     """
-    metadata = MetaData()  # Metadata object to hold table definitions
-    table = Table(table_name, metadata, autoload_with=engine)  # Load the table definition from the database
+    chunk_size = UPSERT_CHUNK_SIZE if chunk_size is None else chunk_size
+    fast_load = SQLITE_FAST_LOAD if fast_load is None else fast_load
 
+    table = get_table(engine, table_name)   # Cached table definition, used to quote the table name
     df = df.reset_index()  # Reset index to ensure 'ticker' and 'year' are columns
-    rows = df.to_dict(orient="records")  # Convert DataFrame to a list of dictionaries for insertion
-    stmt = insert(table).values(rows)   # Create an insert statement with the rows to be inserted
-    update_dict = {c.key: c for c in stmt.excluded if c.key not in keys}    # Create a dictionary of columns to update if a conflict occurs
-    stmt = stmt.on_conflict_do_update(index_elements=keys, set_=update_dict)    # Handle conflicts by updating existing rows based on the specified keys
+    columns = list(df.columns)
+
+    # Prepared statement: one row of placeholders, conflicts on the keys update the remaining columns
+    column_list = ", ".join(f'"{c}"' for c in columns)
+    placeholders = ", ".join(["?"] * len(columns))
+    updates = ", ".join(f'"{c}" = excluded."{c}"' for c in columns if c not in keys)
+    on_conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+    key_list = ", ".join(f'"{k}"' for k in keys)
+    sql = f'INSERT INTO "{table.name}" ({column_list}) VALUES ({placeholders}) ON CONFLICT ({key_list}) {on_conflict}'
+
+    with engine.begin() as conn:
+        if fast_load:
+            set_fast_load_pragmas(conn)
+        for start in range(0, len(df), chunk_size):
+            rows = _to_rows(df.iloc[start:start + chunk_size])
+            conn.exec_driver_sql(sql, rows)     # executemany of the prepared statement
+    increment('rows_written', len(df))
+    increment(f'rows_written.{table_name}', len(df))
+    return len(df)
+
+def get_table(engine, table_name):
+    """
+    Returns the reflected table definition, reflecting it from the database only on first use.
+    :param engine: SQLAlchemy engine object
+    :param table_name: Name of the table
+    :return: SQLAlchemy Table object
+    """
+    key = (str(engine.url), table_name)
+    table = _table_cache.get(key)
+    if table is None:
+        metadata = MetaData()  # Metadata object to hold table definitions
+        table = Table(table_name, metadata, autoload_with=engine)  # Load the table definition from the database
+        _table_cache[key] = table
+    return table
+
+def set_fast_load_pragmas(conn):
+    """
+    Speeds up bulk loads into SQLite: write-ahead logging and fewer fsyncs (safe against application crashes).
+    :param conn: SQLAlchemy connection, before any statement of the transaction has been executed
+    :return: None
+    """
+    conn.exec_driver_sql("PRAGMA journal_mode=WAL")     # Persistent for the database file
+    conn.exec_driver_sql("PRAGMA synchronous=NORMAL")   # Per connection
+    return
+
+def _to_rows(df):
+    """
+    Converts a DataFrame chunk into a list of tuples of native Python values for executemany.
+    Missing values become None and datetimes become strings in SQLAlchemy's SQLite storage format.
+    """
+    values = []
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            col = series.dt.strftime("%Y-%m-%d %H:%M:%S.%f").tolist()
+        else:
+            col = series.tolist()
+        if series.hasnans:
+            col = [None if v is None or v != v else v for v in col]   # NaN/NaT to NULL (v != v only for NaN)
+        values.append(col)
+    return list(zip(*values))
+
+def start_run(engine, assumptions):
+    """
+    Registers a new valuation run with the assumptions it uses.
+    :param engine: SQLAlchemy engine object
+    :param assumptions: Dictionary with keys ['growth_rate', 'discount_rate', 'terminal_growth', 'years', 'risk_free_return', 'market_return']
+    :return: Run id (sortable timestamp string)
+    """
+    now_utc = datetime.now(timezone.utc)
+    run_id = now_utc.strftime("%Y%m%dT%H%M%S%fZ")
+    sql = text("""INSERT INTO valuation_runs (run_id, date, growth_rate, discount_rate, terminal_growth, years, risk_free_return, market_return)
+                  VALUES (:run_id, :date, :growth_rate, :discount_rate, :terminal_growth, :years, :risk_free_return, :market_return)""")
+    with engine.begin() as conn:
+        conn.execute(sql, {"run_id": run_id, "date": now_utc, **assumptions})
+    return run_id
+
+@timed('db.save_results')
+def save_results(engine, dcf_df, results_df, run_id):
+    """
+    Persists a valuation run, writing only tickers whose valuation changed since the latest stored result.
+    Changed tickers get their dcf_table rows replaced, their results_table row upserted and a results_history row appended.
+    Their valuation fingerprints are deleted, run_valuation stores new ones after saving.
+    :param engine: SQLAlchemy engine object
+    :param dcf_df: DataFrame with DCF calculations indexed by ticker then year (from run_dcf)
+    :param results_df: DataFrame with results indexed by ticker (from run_dcf)
+    :param run_id: Id of the run from start_run
+    :return: List of tickers that changed
+    """
+    results_df = results_df.rename_axis("ticker")
+    latest = read_results(engine, results_df.index).reindex(results_df.index)   # Latest stored result of these tickers only
+
+    new_values = results_df[RESULT_COLUMNS].to_numpy(dtype=float)
+    old_values = latest[RESULT_COLUMNS].to_numpy(dtype=float)
+    same = (new_values == old_values) | (np.isnan(new_values) & np.isnan(old_values))
+    changed = results_df.index[~same.all(axis=1)]
+    if len(changed) == 0:
+        return []
+
+    changed_dcf = dcf_df[dcf_df.index.get_level_values("ticker").isin(changed)]
+    delete_tickers(engine, "dcf_table", changed)    # Projection years move with the base year, so replace the rows
+    upsert_data(engine, changed_dcf, "dcf_table", ["ticker", "year"])
+
+    changed_results = results_df.loc[changed]
+    upsert_data(engine, changed_results, "results_table", ["ticker"])
+    upsert_data(engine, changed_results.assign(run_id=run_id), "results_history", ["run_id", "ticker"])
+    delete_tickers(engine, "valuation_fingerprints", changed)   # Their stored fingerprints describe the replaced results
+    return list(changed)
 
+def get_fingerprints(engine, tickers):
+    """
+    Returns the input fingerprints of the given tickers' stored results.
+    Tickers without a row in results_table have no fingerprint, so that they are always valued.
+    :param engine: SQLAlchemy engine object
+    :param tickers: List of tickers
+    :return: Series of uint64 fingerprints indexed by ticker
+    """
+    sql = f"""SELECT s.ticker, v.fingerprint FROM {SELECTED_TICKERS} s
+              JOIN valuation_fingerprints v ON v.ticker = s.ticker
+              JOIN results_table r ON r.ticker = s.ticker"""
     with engine.begin() as conn:
-        conn.execute(stmt)  # Execute the upsert statement within a transaction
+        select_tickers(conn, tickers)
+        rows = conn.exec_driver_sql(sql).fetchall()
+    fingerprints = np.array([row[1] for row in rows], dtype=np.int64).view(np.uint64)   # Stored as signed 64-bit integers
+    return pd.Series(fingerprints, index=pd.Index([row[0] for row in rows], name="ticker"), dtype=np.uint64)
+
+def save_fingerprints(engine, fingerprints, run_id):
+    """
+    Stores the input fingerprints of tickers valued in a run.
+    :param engine: SQLAlchemy engine object
+    :param fingerprints: Series of uint64 fingerprints indexed by ticker (from input_fingerprints)
+    :param run_id: Id of the run from start_run
+    :return: None
+    """
+    signed = fingerprints.to_numpy(dtype=np.uint64).view(np.int64)     # SQLite integers are signed 64-bit
+    df = pd.DataFrame({"fingerprint": signed, "run_id": run_id}, index=fingerprints.index.rename("ticker"))
+    upsert_data(engine, df, "valuation_fingerprints", ["ticker"])
     return
 
+def read_results(engine, tickers):
+    """
+    Reads the stored results of the given tickers.
+    :param engine: SQLAlchemy engine object
+    :param tickers: List of tickers
+    :return: DataFrame indexed by ticker with columns ['date', 'share_price', 'estimated_price', 'margin_of_safety']
+    """
+    sql = f"""SELECT r.ticker, r.date, r.share_price, r.estimated_price, r.margin_of_safety
+              FROM {SELECTED_TICKERS} s JOIN results_table r ON r.ticker = s.ticker"""
+    with engine.begin() as conn:
+        select_tickers(conn, tickers)
+        rows = conn.exec_driver_sql(sql).fetchall()
+    df = pd.DataFrame(rows, columns=["ticker", "date", *RESULT_COLUMNS]).set_index("ticker")
+    df["date"] = pd.to_datetime(df["date"])
+    return df.astype({column: float for column in RESULT_COLUMNS})
+
+def save_simulation_results(engine, simulation_df, run_id):
+    """
+    Persists the Monte Carlo summary of a run.
+    :param engine: SQLAlchemy engine object
+    :param simulation_df: DataFrame indexed by ticker (from run_monte_carlo)
+    :param run_id: Id of the run from start_run
+    :return: None
+    """
+    upsert_data(engine, simulation_df.assign(run_id=run_id), "simulation_results", ["run_id", "ticker"])
+    return
+
+def delete_tickers(engine, table_name, tickers):
+    """
+    Deletes all rows of the given tickers from a table.
+    :param engine: SQLAlchemy engine object
+    :param table_name: Name of the table to delete rows from
+    :param tickers: List of tickers to delete
+    :return: None
+    """
+    table = get_table(engine, table_name)
+    with engine.begin() as conn:
+        conn.exec_driver_sql(f'DELETE FROM "{table.name}" WHERE ticker = ?', [(ticker,) for ticker in tickers])
+    return
+
+@timed('db.read')
+def read_financial_data(engine, tickers, latest_only=False):
+    """
+    Reads the financial data of the given tickers, sorted by ticker and year in descending order.
+    :param engine: SQLAlchemy engine object
+    :param tickers: List of tickers to read
+    :param latest_only: If True, read only the latest year of each ticker
+    :return: DataFrame with financial data indexed by ticker then year, with float columns
+    """
+    tickers, arrays = read_financial_arrays(engine, tickers, latest_only)
+    years = arrays.pop('year')
+    return pd.DataFrame(arrays, index=pd.MultiIndex.from_arrays([tickers, years], names=["ticker", "year"]))
+
+def read_financial_arrays(engine, tickers, latest_only=False):
+    """
+    Reads the financial data of the given tickers into typed NumPy arrays, sorted by ticker and year in descending order.
+    The tickers are filtered through a temporary table rather than one bound parameter each, so any number of
+    tickers can be read, and the latest year per ticker is selected in SQL.
+    :param engine: SQLAlchemy engine object
+    :param tickers: List of tickers to read
+    :param latest_only: If True, read only the latest year of each ticker
+    :return: Tuple of (array of tickers, dictionary mapping every other column to a float array, or an
+        integer array for integer columns without missing values)
+    """
+    table = get_table(engine, "financial_data")
+    columns = [column.name for column in table.columns]
+    column_list = ", ".join(f'f."{name}"' for name in columns)
+    if latest_only:     # Latest year of each ticker, found through the primary key index on (ticker, year)
+        sql = f"""SELECT {column_list} FROM {SELECTED_TICKERS} s JOIN financial_data f ON f.ticker = s.ticker
+                  AND f.year = (SELECT MAX(m.year) FROM financial_data m WHERE m.ticker = s.ticker)
+                  ORDER BY s.ticker ASC"""
+    else:
+        sql = f"""SELECT {column_list} FROM financial_data f JOIN {SELECTED_TICKERS} s ON s.ticker = f.ticker
+                  ORDER BY f.ticker ASC, f.year DESC"""
+
+    with engine.begin() as conn:
+        select_tickers(conn, tickers)
+        cursor = conn.connection.cursor()   # Plain DBAPI tuples, converted column by column below
+        rows = cursor.execute(sql).fetchall()
+        cursor.close()
+    increment('rows_read', len(rows))
+
+    values = list(zip(*rows)) if rows else [()] * len(columns)
+    arrays = {}
+    for column, column_values in zip(table.columns, values):
+        if isinstance(column.type, String):
+            arrays[column.name] = np.array(column_values, dtype=object)
+        else:
+            array = np.array(column_values, dtype=float)    # NULL becomes NaN
+            if isinstance(column.type, Integer) and not np.isnan(array).any():
+                array = array.astype(np.int64)
+            arrays[column.name] = array
+    return arrays.pop("ticker"), arrays
+
+def select_tickers(conn, tickers):
+    """
+    Fills the temporary table that queries join to filter on a list of tickers, avoiding SQLite's limit on bound parameters.
+    :param conn: SQLAlchemy connection, the table is only visible on this connection
+    :param tickers: List of tickers, duplicates are ignored
+    :return: None
+    """
+    conn.exec_driver_sql(f"CREATE TEMP TABLE IF NOT EXISTS {SELECTED_TICKERS} (ticker TEXT PRIMARY KEY) WITHOUT ROWID")
+    conn.exec_driver_sql(f"DELETE FROM {SELECTED_TICKERS}")
+    if len(tickers) > 0:
+        conn.exec_driver_sql(f"INSERT OR IGNORE INTO {SELECTED_TICKERS} (ticker) VALUES (?)", [(ticker,) for ticker in tickers])
+    return
+
+def start_pipeline_run(engine, run_id):
+    """
+    Registers a streaming run so that it can be resumed until it is finished.
+    :param engine: SQLAlchemy engine object
+    :param run_id: Id of the run from start_run
+    :return: None
+    """
+    sql = text("INSERT INTO pipeline_runs (run_id, started) VALUES (:run_id, :started)")
+    with engine.begin() as conn:
+        conn.execute(sql, {"run_id": run_id, "started": datetime.now(timezone.utc)})
+    return
+
+def get_unfinished_pipeline_run(engine):
+    """
+    Returns the id of the latest streaming run that has not finished, or None.
+    :param engine: SQLAlchemy engine object
+    :return: Run id or None
+    """
+    sql = text("SELECT run_id FROM pipeline_runs WHERE finished IS NULL ORDER BY started DESC LIMIT 1")
+    with engine.connect() as conn:
+        row = conn.execute(sql).fetchone()
+    return None if row is None else row[0]
+
+def get_completed_tickers(engine, run_id):
+    """
+    Returns the tickers a streaming run has already completed.
+    :param engine: SQLAlchemy engine object
+    :param run_id: Id of the run
+    :return: Set of tickers
+    """
+    sql = text("SELECT ticker FROM run_progress WHERE run_id = :run_id")
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(sql, {"run_id": run_id})}
+
+def mark_completed(engine, run_id, tickers):
+    """
+    Checkpoints tickers of a streaming run as completed.
+    :param engine: SQLAlchemy engine object
+    :param run_id: Id of the run
+    :param tickers: List of completed tickers
+    :return: None
+    """
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT OR IGNORE INTO run_progress (run_id, ticker) VALUES (?, ?)",
+                             [(run_id, ticker) for ticker in tickers])
+    return
+
+def finish_pipeline_run(engine, run_id):
+    """
+    Marks a streaming run as finished and removes its checkpoints.
+    :param engine: SQLAlchemy engine object
+    :param run_id: Id of the run
+    :return: None
+    """
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE pipeline_runs SET finished = :finished WHERE run_id = :run_id"),
+                     {"run_id": run_id, "finished": datetime.now(timezone.utc)})
+        conn.execute(text("DELETE FROM run_progress WHERE run_id = :run_id"), {"run_id": run_id})
+    return
+
+def get_valuation_history(engine, ticker):
+    """
+    Returns the valuation history of a ticker, one row per run in which its valuation changed.
+    :param engine: SQLAlchemy engine object
+    :param ticker: Ticker to query
+    :return: DataFrame indexed by date with columns ['run_id', 'share_price', 'estimated_price', 'margin_of_safety']
+    """
+    sql = text("""SELECT date, run_id, share_price, estimated_price, margin_of_safety
+                  FROM results_history WHERE ticker = :ticker ORDER BY date""")
+    return pd.read_sql(sql, engine, params={"ticker": ticker}, index_col="date", parse_dates=["date"])
+
 # TODO: - Add error handling for database operations
 def get_last_updated(engine, table_name):
     """    Retrieve the last updated timestamp for a specific table.
@@ -145,10 +588,13 @@ def should_fetch_data(engine, tickers, table_name, max_days):
     :param max_days: Maximum number of days since last update to consider fetching new data
     :return: True if new data should be fetched, False otherwise
     """
-    existing_tickers = get_column_values(engine, table_name, "ticker")  # Get existing tickers from the specified table
-    for ticker in tickers:
-        if not ticker in existing_tickers:
-            return True
+    table = get_table(engine, table_name)
+    with engine.begin() as conn:    # Look for a ticker without data in the table, using its index on ticker
+        select_tickers(conn, tickers)
+        missing = conn.exec_driver_sql(f"""SELECT 1 FROM {SELECTED_TICKERS} s WHERE NOT EXISTS
+                                           (SELECT 1 FROM "{table.name}" t WHERE t.ticker = s.ticker) LIMIT 1""").fetchone()
+    if missing is not None:
+        return True
     last = get_last_updated(engine, table_name)
     if last is None or pd.isna(last):   # If last updated is None or NaT, fetch new data
         return True
@@ -156,6 +602,54 @@ def should_fetch_data(engine, tickers, table_name, max_days):
         last = last.replace(tzinfo=timezone.utc)    # Convert to UTC timezone
     return datetime.now(timezone.utc) - last > timedelta(days=max_days)
 
+@timed('db.stale_check')
+def get_stale_tickers(engine, tickers, category, max_days):
+    """
+    Determines which tickers need new data, i.e. tickers never fetched for the category or last updated more than max_days ago.
+    :param engine: SQLAlchemy engine object
+    :param tickers: List of tickers to check
+    :param category: Category the tickers are tracked for (e.g. 'financial_data')
+    :param max_days: Maximum number of days since last update before a ticker is considered stale
+    :return: List of stale tickers, in the order of the given tickers
+    """
+    with engine.begin() as conn:    # Only the status of the given tickers is read, by primary key
+        select_tickers(conn, tickers)
+        sql = f"""SELECT s.ticker, t.last_updated FROM {SELECTED_TICKERS} s
+                  JOIN ticker_status t ON t.ticker = s.ticker AND t.category = ?"""
+        last_updated = dict(conn.exec_driver_sql(sql, (category,)).fetchall())   # Map ticker to its last update
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_days)
+    stale = []
+    for ticker in tickers:
+        last = last_updated.get(ticker)
+        if last is None:    # Never fetched for this category
+            stale.append(ticker)
+            continue
+        last = last if isinstance(last, datetime) else datetime.fromisoformat(last)
+        if last.tzinfo is None:  # Naive timestamps are stored in UTC
+            last = last.replace(tzinfo=timezone.utc)
+        if last < cutoff:
+            stale.append(ticker)
+    return stale
+
+def update_ticker_status(engine, tickers, category):
+    """
+    Marks the given tickers as updated now for a category.
+    :param engine: SQLAlchemy engine object
+    :param tickers: List of tickers that were updated
+    :param category: Category the tickers were updated for (e.g. 'financial_data')
+    :return: None
+    """
+    if len(tickers) == 0:
+        return
+    now_utc = datetime.now(timezone.utc)
+    sql = text("""INSERT INTO ticker_status (ticker, category, last_updated)
+                  VALUES (:ticker, :category, :updated) ON CONFLICT (ticker, category)
+                  DO UPDATE SET last_updated = excluded.last_updated""")
+    with engine.begin() as conn:
+        conn.execute(sql, [{"ticker": ticker, "category": category, "updated": now_utc} for ticker in tickers])   # executemany
+    return
+
 def get_column_values(engine, table_name, column_name):
     """
     Returns a list of all values in a specific column.
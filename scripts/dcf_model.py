@@ -1,11 +1,25 @@
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from scripts.config import RISK_FREE_RETURN, MARKET_RETURN
+from itertools import repeat
+import atexit
+from scripts.config import RISK_FREE_RETURN, MARKET_RETURN, VALUATION_MIN_SHARD
+from scripts.instrumentation import timed, stage
 
+INPUT_COLUMNS = ['fcf', 'total_debt', 'tax_rate', 'interest_expense', 'shares_outstanding', 'market_cap', 'beta', 'share_price']
+WACC_FLOOR = 0.08   # Minimum WACC to prevent overvaluation of companies
+SIMULATION_PERCENTILES = (5, 25, 50, 75, 95)   # Percentiles of the estimated price stored per ticker
+SIMULATION_RATE_STEP = 0.0001   # Tickers whose WACC agrees to 1 basis point share simulated samples
+YEAR_KEY_BASE = 10_000  # Multiplier combining a ticker code and a fiscal year into one integer key
+_pools = {}     # Process pools of map_shards by number of workers, started once and reused for the life of the process
+
+@timed('dcf')
 def run_dcf(df, growth_rate, discount_rate, terminal_growth, years):
     """
     Runs the DCF model on the provided financial data.
+    All tickers are valued in one batched pass over the latest row of each ticker, in this process: the pass is
+    cheaper than shipping the arrays to worker processes (see `python -m scripts.benchmark workers`).
     :param df: DataFrame containing financial data with columns ['fcf', 'total_debt', 'tax_rate', 'interest_expense', 'shares_outstanding', 'market_cap', 'beta', 'share_price']
     :param growth_rate: Annual growth rate for projected free cash flows
     :param discount_rate: Discount rate for DCF calculations
@@ -15,27 +29,280 @@ def run_dcf(df, growth_rate, discount_rate, terminal_growth, years):
     """
     print("Running DCF model...")
 
-    tickers = df.index.get_level_values('ticker').unique()  # Get unique tickers from the DataFrame index
-
-    all_dcf = []    # List to store DCF calculations for each ticker
-    results = {}    # Dictionary to store results for each ticker
+    tickers, arrays = latest_arrays(df)     # One row of inputs per ticker as NumPy arrays
+    with stage('dcf.value'):
+        values = value_arrays(arrays, growth_rate, discount_rate, terminal_growth, years)
+    return dcf_frames(tickers, arrays, values, years)
 
-    for ticker in tickers:
-        ticker_df = df.loc[ticker]
-        wacc = calculate_wacc(ticker_df, RISK_FREE_RETURN, MARKET_RETURN, discount_rate)
-        ticker_dcf, share_price = calculate_dcf(ticker_df, growth_rate, wacc, terminal_growth, years)   # Calculate DCF for the ticker
+@timed('dcf.staged')
+def run_staged_dcf(df, growth_rate, discount_rate, terminal_growth, years, high_growth_years=None, fade_years=0,
+                   stable_growth=None, risk_free_curve=None, mid_year=False):
+    """
+    Runs a multi-stage DCF model with a time-varying discount rate on the provided financial data.
+    Growth is growth_rate for high_growth_years, fades linearly over fade_years and then stays at stable_growth.
+    The WACC of every projected year uses that year's risk-free rate from risk_free_curve.
+    With the default arguments the result equals run_dcf.
+    :param df: DataFrame with financial data indexed by ticker then year
+    :param growth_rate: Annual growth rate in the high growth stage
+    :param discount_rate: Discount rate for DCF calculations (kept for parity with run_dcf, see calculate_wacc_batch)
+    :param terminal_growth: Terminal growth rate for calculating terminal value
+    :param years: Number of years to project free cash flows
+    :param high_growth_years: Years of growth_rate (default all years, a single stage)
+    :param fade_years: Years over which growth fades linearly to stable_growth (0 for a two-stage model)
+    :param stable_growth: Growth after the fade (default growth_rate)
+    :param risk_free_curve: Risk-free rate per projected year, the last rate is used for later years (default RISK_FREE_RETURN)
+    :param mid_year: If True, discount the cash flows of each year from the middle of the year
+    :return: DataFrame with DCF results and a summary DataFrame with estimated prices and margin of safety
+    """
+    print("Running staged DCF model...")
 
-        ticker_dcf.index = pd.MultiIndex.from_product([[ticker], ticker_dcf.index], names=["ticker", "year"])   # Set MultiIndex for DCF DataFrame
+    growth = growth_schedule(years, growth_rate, high_growth_years, fade_years, stable_growth)
+    rf = rate_curve(RISK_FREE_RETURN if risk_free_curve is None else risk_free_curve, years)
+    tickers, arrays = latest_arrays(df)
+    with stage('dcf.value'):
+        values = value_arrays_staged(arrays, growth, rf, discount_rate, terminal_growth, mid_year)
+    return dcf_frames(tickers, arrays, values, years)
 
-        all_dcf.append(ticker_dcf)  # Append DCF calculation DataFrame to the list
-        margin_of_safety =  ((share_price - ticker_df['share_price'].iloc[0]) / share_price) * 100
-        results[ticker] = [datetime.now(), ticker_df['share_price'].iloc[0], share_price, margin_of_safety]
+def dcf_frames(tickers, arrays, values, years):
+    """
+    Builds the DCF and results DataFrames of run_dcf from the valued arrays.
+    :param tickers: Array of tickers
+    :param arrays: Dictionary of input arrays per ticker (see latest_arrays)
+    :param values: Dictionary of valued arrays per ticker (see value_arrays)
+    :param years: Number of projected years
+    :return: DataFrame with DCF results indexed by ticker and year, and a summary DataFrame indexed by ticker
+    """
+    # Long (ticker, year) layout of the projections, NaN terminal values except for the last year
+    year_index = arrays['year'][:, None] + np.arange(1, years + 1)
+    projected_tv = np.full((len(tickers), years), np.nan)
+    projected_tv[:, -1] = values['terminal_value']
+    discounted_tv_matrix = np.full((len(tickers), years), np.nan)
+    discounted_tv_matrix[:, -1] = values['discounted_tv']
 
+    index = pd.MultiIndex.from_arrays([np.repeat(tickers, years), year_index.ravel()], names=["ticker", "year"])
+    dcf_df = pd.DataFrame({
+        'projected_fcf': values['projected_fcf'].ravel(),
+        'discounted_fcf': values['discounted_fcf'].ravel(),
+        'projected_tv': projected_tv.ravel(),
+        'discounted_tv': discounted_tv_matrix.ravel(),
+    }, index=index)
 
-    results_df = pd.DataFrame.from_dict(results, orient="index", columns=["date", "share_price", "estimated_price", "margin_of_safety"])
-    dcf_df = pd.concat(all_dcf)
+    results_df = pd.DataFrame({
+        'date': datetime.now(),
+        'share_price': arrays['share_price'],
+        'estimated_price': values['estimated_price'],
+        'margin_of_safety': values['margin_of_safety'],
+    }, index=pd.Index(tickers))
     return dcf_df, results_df
 
+def value_arrays(arrays, growth_rate, discount_rate, terminal_growth, years, rf=RISK_FREE_RETURN, rm=MARKET_RETURN):
+    """
+    Values a batch of tickers given as compact arrays (WACC, projections, terminal value and estimated price).
+    Runs in worker processes when run_dcf shards the tickers, so it only takes and returns NumPy arrays.
+    :param arrays: Dictionary of NumPy arrays per input column (see latest_arrays)
+    :param growth_rate: Annual growth rate for projected free cash flows
+    :param discount_rate: Discount rate for DCF calculations
+    :param terminal_growth: Terminal growth rate for calculating terminal value
+    :param years: Number of years to project free cash flows
+    :param rf: Risk-free rate for the WACC (default RISK_FREE_RETURN)
+    :param rm: Market return for the WACC (default MARKET_RETURN)
+    :return: Dictionary of NumPy arrays with keys ['wacc', 'projected_fcf', 'discounted_fcf', 'terminal_value',
+        'discounted_tv', 'estimated_price', 'margin_of_safety']
+    """
+    wacc = calculate_wacc_batch(arrays, rf, rm, discount_rate)
+    projected_fcf, discounted_fcf, terminal_value, discounted_tv, share_price = calculate_dcf_batch(
+        arrays['fcf'], arrays['shares_outstanding'], growth_rate, wacc, terminal_growth, years)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margin_of_safety = ((share_price - arrays['share_price']) / share_price) * 100
+
+    return {'wacc': wacc, 'projected_fcf': projected_fcf, 'discounted_fcf': discounted_fcf, 'terminal_value': terminal_value,
+            'discounted_tv': discounted_tv, 'estimated_price': share_price, 'margin_of_safety': margin_of_safety}
+
+def value_arrays_staged(arrays, growth, rf, discount_rate, terminal_growth, mid_year=False, rm=MARKET_RETURN):
+    """
+    Values a batch of tickers with a growth schedule and a WACC per projected year, like value_arrays.
+    :param arrays: Dictionary of NumPy arrays per input column (see latest_arrays)
+    :param growth: Growth rate per projected year (see growth_schedule)
+    :param rf: Risk-free rate per projected year (see rate_curve)
+    :param discount_rate: Discount rate for DCF calculations (kept for parity with value_arrays)
+    :param terminal_growth: Terminal growth rate for calculating terminal value
+    :param mid_year: If True, discount the cash flows of each year from the middle of the year
+    :param rm: Market return for the WACC (default MARKET_RETURN)
+    :return: Dictionary of NumPy arrays as value_arrays, with 'wacc' of shape (tickers, years)
+    """
+    columns = {column: values[:, None] for column, values in arrays.items()}   # One column per ticker, broadcast over years
+    wacc = calculate_wacc_batch(columns, rf, rm, discount_rate)
+    projected_fcf, discounted_fcf, terminal_value, discounted_tv, share_price = calculate_dcf_schedule(
+        arrays['fcf'], arrays['shares_outstanding'], growth, wacc, terminal_growth, mid_year)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margin_of_safety = ((share_price - arrays['share_price']) / share_price) * 100
+
+    return {'wacc': wacc, 'projected_fcf': projected_fcf, 'discounted_fcf': discounted_fcf, 'terminal_value': terminal_value,
+            'discounted_tv': discounted_tv, 'estimated_price': share_price, 'margin_of_safety': margin_of_safety}
+
+def map_shards(func, arrays, workers, *args, min_shard_size=VALUATION_MIN_SHARD):
+    """
+    Applies func(arrays, *args) to contiguous shards of the tickers on a process pool and merges the results in shard order.
+    Only worth it when func does much more work per ticker than it takes to pickle its inputs and outputs, like
+    simulate_arrays; the single-pass valuations of value_arrays run faster in one process.
+    :param func: Top-level function taking a dictionary of equally long arrays and returning an array or a dictionary of arrays
+    :param arrays: Dictionary of NumPy arrays with one entry per ticker
+    :param workers: Maximum number of worker processes (1 runs func in this process)
+    :param args: Further arguments passed to func
+    :param min_shard_size: Minimum number of tickers per shard, small universes use fewer workers
+    :return: The results of all shards concatenated along the ticker axis, in the original ticker order
+    """
+    n_tickers = len(next(iter(arrays.values())))
+    workers = min(workers, n_tickers // min_shard_size)
+    if workers <= 1:
+        return func(arrays, *args)
+
+    bounds = np.linspace(0, n_tickers, workers + 1).astype(int)
+    shards = [{key: values[start:end] for key, values in arrays.items()} for start, end in zip(bounds[:-1], bounds[1:])]
+    parts = list(get_pool(workers).map(func, shards, *[repeat(arg) for arg in args]))    # map keeps the shard order
+
+    if isinstance(parts[0], dict):
+        return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+    return np.concatenate(parts)
+
+def get_pool(workers):
+    """
+    Returns the process pool with the given number of workers, starting it on first use.
+    Starting worker processes costs far more than a batched valuation, so a pool serves every later call.
+    :param workers: Number of worker processes
+    :return: ProcessPoolExecutor
+    """
+    if workers not in _pools:
+        _pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _pools[workers]
+
+@atexit.register
+def shutdown_pools():
+    """
+    Shuts down the process pools of map_shards.
+    """
+    while _pools:
+        _pools.popitem()[1].shutdown()
+
+def latest_arrays(df, columns=INPUT_COLUMNS):
+    """
+    Extracts the latest row for every ticker as NumPy arrays.
+    Assumes the rows of each ticker are sorted by year in descending order, as returned by get_financial_data.
+    :param df: DataFrame with financial data indexed by ticker then year
+    :param columns: Columns to extract as float arrays
+    :return: Tuple of (array of tickers, dictionary mapping column name (and 'year') to a NumPy array)
+    """
+    latest = df.groupby(level='ticker', sort=False).head(1)     # First row per ticker in order of appearance
+    tickers = latest.index.get_level_values('ticker').to_numpy()
+    arrays = {col: pd.to_numeric(latest[col], errors='coerce').to_numpy(dtype=float) for col in columns}
+    arrays['year'] = latest.index.get_level_values('year').to_numpy(dtype=np.int64)
+    return tickers, arrays
+
+def input_fingerprints(df, assumptions, columns=INPUT_COLUMNS):
+    """
+    Fingerprints the inputs of every ticker's valuation: its latest row of financial data and the assumptions.
+    A ticker whose fingerprint is unchanged since its stored result values to the same result.
+    :param df: DataFrame with financial data indexed by ticker then year
+    :param assumptions: Dictionary of the assumptions (see main.current_assumptions)
+    :param columns: Input columns of the valuation
+    :return: Series of uint64 fingerprints indexed by ticker
+    """
+    tickers, arrays = latest_arrays(df, columns)
+    inputs = pd.DataFrame(arrays, index=pd.Index(tickers, name='ticker'))
+    inputs = inputs.assign(**{name: float(value) for name, value in sorted(assumptions.items())})   # Same assumptions in every row
+    return pd.util.hash_pandas_object(inputs, index=True)
+
+def calculate_dcf_batch(fcf, shares_outstanding, growth_rate, discount_rate, terminal_growth, years=5):
+    """
+    Calculates the DCF model for many tickers at once using broadcasting.
+    :param fcf: Array with the latest free cash flow per ticker
+    :param shares_outstanding: Array with shares outstanding per ticker
+    :param growth_rate: Annual growth rate for projected free cash flows
+    :param discount_rate: Discount rate per ticker (array) or a single rate for all tickers
+    :param terminal_growth: Terminal growth rate for calculating terminal value
+    :param years: Number of years to project free cash flows (default is 5)
+    :return: Tuple of (projected fcf, discounted fcf, terminal value, discounted terminal value, estimated share price),
+        the first two with shape (tickers, years) and the rest with shape (tickers,)
+    """
+    fcf = np.asarray(fcf, dtype=float)
+    discount_rate = np.broadcast_to(np.asarray(discount_rate, dtype=float), fcf.shape)
+    periods = np.arange(1, years + 1)   # Projection periods 1..years
+
+    projected_fcf = fcf[:, None] * (1 + growth_rate) ** periods     # Projected Free Cash Flows (FCF)
+    discounted_fcf = projected_fcf / (1 + discount_rate[:, None]) ** periods   # Discounted Free Cash Flows (DCF)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terminal_value = projected_fcf[:, -1] * (1 + terminal_growth) / (discount_rate - terminal_growth)   # Terminal Value (TV)
+        discounted_tv = terminal_value / ((1 + discount_rate) ** years)     # Discounted Terminal Value (DTV)
+        share_price = (discounted_fcf.sum(axis=1) + discounted_tv) / np.asarray(shares_outstanding, dtype=float)
+
+    return projected_fcf, discounted_fcf, terminal_value, discounted_tv, share_price
+
+def calculate_dcf_schedule(fcf, shares_outstanding, growth, discount_rate, terminal_growth, mid_year=False):
+    """
+    Calculates the DCF model for many tickers with a growth rate and a discount rate per projected year.
+    Growth and discounting are cumulative products over the years, so every year and ticker is valued in one pass.
+    With a constant growth and discount rate the result equals calculate_dcf_batch.
+    :param fcf: Array with the latest free cash flow per ticker
+    :param shares_outstanding: Array with shares outstanding per ticker
+    :param growth: Growth rate per projected year, shape (years,) or (tickers, years)
+    :param discount_rate: Discount rate per ticker and year, shape (tickers, years) or broadcastable, e.g. (tickers, 1) or (years,)
+    :param terminal_growth: Terminal growth rate for calculating terminal value
+    :param mid_year: If True, discount the cash flows of each year from the middle of the year (the terminal value
+        is still discounted from the end of the last year)
+    :return: Tuple of (projected fcf, discounted fcf, terminal value, discounted terminal value, estimated share price),
+        the first two with shape (tickers, years) and the rest with shape (tickers,)
+    """
+    fcf = np.asarray(fcf, dtype=float)
+    growth = np.asarray(growth, dtype=float)
+    shape = (len(fcf), growth.shape[-1])
+    growth = np.broadcast_to(growth, shape)
+    discount_rate = np.broadcast_to(np.asarray(discount_rate, dtype=float), shape)
+
+    projected_fcf = fcf[:, None] * np.cumprod(1 + growth, axis=1)     # Projected Free Cash Flows (FCF)
+    discount_factor = np.cumprod(1 / (1 + discount_rate), axis=1)    # Present value of 1 at the end of each year
+    if mid_year:
+        flow_factor = discount_factor * np.sqrt(1 + discount_rate)    # Half a year less of the year's own rate
+    else:
+        flow_factor = discount_factor
+    discounted_fcf = projected_fcf * flow_factor   # Discounted Free Cash Flows (DCF)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terminal_value = projected_fcf[:, -1] * (1 + terminal_growth) / (discount_rate[:, -1] - terminal_growth)   # Terminal Value (TV) at the last year's rate
+        discounted_tv = terminal_value * discount_factor[:, -1]     # Discounted Terminal Value (DTV)
+        share_price = (discounted_fcf.sum(axis=1) + discounted_tv) / np.asarray(shares_outstanding, dtype=float)
+
+    return projected_fcf, discounted_fcf, terminal_value, discounted_tv, share_price
+
+def growth_schedule(years, growth_rate, high_growth_years=None, fade_years=0, stable_growth=None):
+    """
+    Returns the growth rate of every projected year for a one-, two- or three-stage model.
+    :param years: Number of projected years
+    :param growth_rate: Growth rate in the high growth stage, a number or an array with one rate per ticker
+    :param high_growth_years: Years of growth_rate (default all years, a single stage)
+    :param fade_years: Years over which growth moves linearly from growth_rate to stable_growth (0 for a two-stage model)
+    :param stable_growth: Growth after the fade (default growth_rate)
+    :return: Array of growth rates with shape (years,), or (tickers, years) for a growth rate per ticker
+    """
+    growth_rate = np.asarray(growth_rate, dtype=float)[..., None]
+    stable_growth = growth_rate if stable_growth is None else np.asarray(stable_growth, dtype=float)[..., None]
+    high_growth_years = years if high_growth_years is None else high_growth_years
+    periods = np.arange(1, years + 1)
+    weight = np.clip((periods - high_growth_years) / (fade_years + 1), 0, 1)     # 0 in the high growth stage, 1 once faded
+    return growth_rate + (stable_growth - growth_rate) * weight
+
+def rate_curve(rates, years):
+    """
+    Returns a rate per projected year from a single rate or a curve, e.g. a term structure of risk-free rates.
+    :param rates: A rate, or a sequence of rates for the first years (the last rate is used for later years)
+    :param years: Number of projected years
+    :return: Array of rates with shape (years,)
+    """
+    rates = np.atleast_1d(np.asarray(rates, dtype=float))[:years]
+    return np.concatenate([rates, np.repeat(rates[-1], years - len(rates))])
+
 def calculate_dcf(df, growth_rate, discount_rate, terminal_growth, years=5) -> (pd.DataFrame, float):
     """
     Calculates the DCF model for a given DataFrame of financial data for a specific ticker.
@@ -67,6 +334,188 @@ def calculate_dcf(df, growth_rate, discount_rate, terminal_growth, years=5) -> (
 
     return dcf_df, share_price
 
+def dcf_multiplier(growth_rate, discount_rate, terminal_growth, years):
+    """
+    Closed-form present value of the DCF per unit of base free cash flow, broadcasting over all arguments.
+    With q = (1 + g) / (1 + r) the discounted FCF sum is q * (1 - q^n) / (1 - q) and the discounted terminal value
+    is q^n * (1 + tg) / (r - tg), so estimated price = fcf / shares * dcf_multiplier(...), matching calculate_dcf_batch.
+    :param growth_rate: Annual growth rate for projected free cash flows
+    :param discount_rate: Discount rate
+    :param terminal_growth: Terminal growth rate
+    :param years: Number of years to project free cash flows
+    :return: Array with the multiplier, NaN where the discount rate does not exceed the terminal growth
+    """
+    growth_rate = np.asarray(growth_rate, dtype=float)
+    discount_rate = np.asarray(discount_rate, dtype=float)
+    terminal_growth = np.asarray(terminal_growth, dtype=float)
+    q = (1 + growth_rate) / (1 + discount_rate)
+    q_n = q ** years
+    with np.errstate(divide='ignore', invalid='ignore'):
+        geometric = np.where(np.abs(q - 1) < 1e-12, years, q * (1 - q_n) / (1 - q))   # Sum of q^t for t = 1..years
+        terminal = q_n * (1 + terminal_growth) / (discount_rate - terminal_growth)
+    return np.where(discount_rate > terminal_growth, geometric + terminal, np.nan)
+
+@timed('monte_carlo')
+def run_monte_carlo(df, n_samples, distributions, years, discount_rate, seed=None, workers=1):
+    """
+    Runs a Monte Carlo valuation of every ticker, drawing growth, terminal growth and discount rate shocks per sample.
+    The estimated price is fcf / shares * dcf_multiplier(growth, rate, terminal growth), and the multiplier only
+    depends on a ticker through its WACC. Tickers whose WACC agrees to SIMULATION_RATE_STEP therefore share one
+    sorted vector of simulated multipliers, from which percentiles and probabilities of every ticker in the group are
+    read off by scaling and binary search. Memory stays at O(samples) regardless of the number of tickers.
+    :param df: DataFrame containing financial data indexed by ticker then year
+    :param n_samples: Number of samples to draw
+    :param distributions: Dictionary mapping 'growth_rate', 'terminal_growth' and 'discount_spread' (added to each
+        ticker's WACC) to a tuple (numpy Generator method, *parameters), e.g. ('normal', 0.05, 0.02)
+    :param years: Number of years to project free cash flows
+    :param discount_rate: Default discount rate passed on to the WACC calculation
+    :param seed: Seed for the random number generator
+    :param workers: Number of processes to shard the tickers over (1 simulates all tickers in this process)
+    :return: DataFrame indexed by ticker with the share price, mean and percentiles of the estimated price
+        and the probability that the margin of safety is positive
+    """
+    print(f"Running Monte Carlo simulation with {n_samples} samples...")
+
+    rng = np.random.default_rng(seed)
+    samples = {name: draw_samples(rng, distributions[name], n_samples)
+               for name in ('growth_rate', 'terminal_growth', 'discount_spread')}
+
+    tickers, arrays = latest_arrays(df)
+    wacc = calculate_wacc_batch(arrays, RISK_FREE_RETURN, MARKET_RETURN, discount_rate)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fcf_per_share = arrays['fcf'] / arrays['shares_outstanding']
+    share_price = arrays['share_price']
+
+    # Shards are contiguous in WACC, so that tickers sharing simulated samples end up in the same worker
+    order = np.argsort(wacc, kind='stable')
+    sorted_arrays = {'wacc': wacc[order], 'fcf_per_share': fcf_per_share[order], 'share_price': share_price[order]}
+    summary = np.empty((len(tickers), len(SIMULATION_PERCENTILES) + 2))
+    summary[order] = map_shards(simulate_arrays, sorted_arrays, workers, samples, years)
+
+    columns = ['mean_price'] + [f'p{p}_price' for p in SIMULATION_PERCENTILES] + ['prob_positive_mos']
+    results_df = pd.DataFrame(summary, index=pd.Index(tickers, name='ticker'), columns=columns)
+    results_df.insert(0, 'date', datetime.now())
+    results_df.insert(1, 'share_price', share_price)
+    results_df.insert(2, 'n_samples', n_samples)
+    return results_df
+
+def simulate_arrays(arrays, samples, years):
+    """
+    Summarizes the Monte Carlo valuation of a batch of tickers given as compact arrays.
+    Runs in worker processes when run_monte_carlo shards the tickers.
+    :param arrays: Dictionary of NumPy arrays with keys ['wacc', 'fcf_per_share', 'share_price']
+    :param samples: Dictionary of sample arrays with keys ['growth_rate', 'terminal_growth', 'discount_spread']
+    :param years: Number of years to project free cash flows
+    :return: Array (tickers, 2 + percentiles) with mean, percentiles and probability of a positive margin of safety
+    """
+    n_samples = len(samples['growth_rate'])
+    summary = np.full((len(arrays['wacc']), len(SIMULATION_PERCENTILES) + 2), np.nan)
+    rate_keys, group = np.unique(np.round(arrays['wacc'] / SIMULATION_RATE_STEP).astype(np.int64), return_inverse=True)
+    order = np.argsort(group, kind='stable')    # Tickers ordered by rate group
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(group, minlength=len(rate_keys)))])
+
+    for k, rate_key in enumerate(rate_keys):
+        members = order[bounds[k]:bounds[k + 1]]
+        rate = np.maximum(rate_key * SIMULATION_RATE_STEP + samples['discount_spread'], WACC_FLOOR)
+        multiplier = dcf_multiplier(samples['growth_rate'], rate, samples['terminal_growth'], years)
+        multiplier = np.sort(multiplier[~np.isnan(multiplier)])     # Samples with rate <= terminal growth are dropped
+        if len(multiplier) == 0:
+            continue
+        summary[members] = _summarize_scaled(multiplier, arrays['fcf_per_share'][members], arrays['share_price'][members], n_samples)
+    return summary
+
+def _summarize_scaled(sorted_multiplier, scale, share_price, n_samples):
+    """
+    Summarizes the estimated prices scale * multiplier for tickers sharing one sorted vector of multipliers.
+    :return: Array (tickers, 2 + percentiles) with mean, percentiles and probability of a positive margin of safety
+    """
+    scale = scale[:, None]
+    quantiles = np.percentile(sorted_multiplier, SIMULATION_PERCENTILES)
+    # Scaling by a negative number reverses the order of the samples, so the percentiles mirror
+    percentiles = np.where(scale >= 0, scale * quantiles, scale * np.percentile(sorted_multiplier, [100 - p for p in SIMULATION_PERCENTILES]))
+    mean = scale[:, 0] * sorted_multiplier.mean()
+
+    # A positive margin of safety needs a positive estimate above the price, x > max(price, 0) with x = scale * multiplier.
+    # Negative estimates also give (x - price) / x > 0 but value a loss-making company, not an undervalued one
+    scale = scale[:, 0]
+    valid = np.isfinite(scale) & (scale != 0) & np.isfinite(share_price)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        upper = np.maximum(share_price, 0) / scale
+    n = len(sorted_multiplier)
+    above = lambda v: n - np.searchsorted(sorted_multiplier, v, side='right')    # Count of multipliers > v
+    below = lambda v: np.searchsorted(sorted_multiplier, v, side='left')       # Count of multipliers < v
+    count = np.where(scale > 0, above(upper), below(upper))     # Dividing by a negative scale flips the inequality
+    probability = np.where(valid, count / n_samples, 0.0)
+
+    return np.column_stack([mean, percentiles, probability])
+
+@timed('sensitivity_grid')
+def run_sensitivity_grid(df, growth_rates, discount_rates, terminal_growths, years):
+    """
+    Evaluates the estimated price of every ticker for every combination of the given assumptions.
+    The discount rates are used as given (instead of each ticker's WACC), so the closed-form multiplier of each
+    scenario is computed once and shared by all tickers: estimated price = fcf / shares * multiplier.
+    :param df: DataFrame containing financial data indexed by ticker then year
+    :param growth_rates: Sequence of annual growth rates
+    :param discount_rates: Sequence of discount rates
+    :param terminal_growths: Sequence of terminal growth rates
+    :param years: Sequence of projection horizons in years
+    :return: Tuple of (cube of estimated prices with shape (tickers, growth rates, discount rates, terminal growths, years),
+        dictionary mapping each axis name to its coordinates, array with the share price per ticker)
+    """
+    print("Running sensitivity grid...")
+
+    coords = {
+        'ticker': None,
+        'growth_rate': np.asarray(growth_rates, dtype=float),
+        'discount_rate': np.asarray(discount_rates, dtype=float),
+        'terminal_growth': np.asarray(terminal_growths, dtype=float),
+        'years': np.asarray(years, dtype=np.int64),
+    }
+    multiplier = dcf_multiplier(coords['growth_rate'][:, None, None, None], coords['discount_rate'][None, :, None, None],
+                                coords['terminal_growth'][None, None, :, None], coords['years'][None, None, None, :])
+
+    tickers, arrays = latest_arrays(df)
+    coords['ticker'] = tickers
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fcf_per_share = arrays['fcf'] / arrays['shares_outstanding']
+    cube = fcf_per_share[:, None, None, None, None] * multiplier[None]
+    return cube, coords, arrays['share_price']
+
+def sensitivity_frame(cube, coords, share_price, tickers=slice(None)):
+    """
+    Converts (a slice of tickers of) a sensitivity cube into a tidy long table.
+    :param cube: Cube of estimated prices from run_sensitivity_grid
+    :param coords: Axis coordinates from run_sensitivity_grid
+    :param share_price: Share price per ticker from run_sensitivity_grid
+    :param tickers: Slice of the ticker axis to convert (default all tickers)
+    :return: DataFrame indexed by (ticker, growth_rate, discount_rate, terminal_growth, years)
+        with columns ['estimated_price', 'margin_of_safety']
+    """
+    cube = cube[tickers]
+    names = list(coords)
+    axes = [coords['ticker'][tickers]] + [coords[name] for name in names[1:]]
+    index = pd.MultiIndex.from_product(axes, names=names)
+    estimated_price = cube.ravel()
+    price = np.repeat(share_price[tickers], cube[0].size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        margin_of_safety = ((estimated_price - price) / estimated_price) * 100
+    return pd.DataFrame({'estimated_price': estimated_price, 'margin_of_safety': margin_of_safety}, index=index)
+
+def draw_samples(rng, distribution, n_samples):
+    """
+    Draws samples from a distribution specification.
+    :param rng: NumPy random Generator
+    :param distribution: Tuple (Generator method, *parameters), e.g. ('normal', 0.05, 0.02) or ('uniform', 0.01, 0.03).
+        A plain number is treated as a constant.
+    :param n_samples: Number of samples to draw
+    :return: Array with n_samples values
+    """
+    if np.isscalar(distribution):
+        return np.full(n_samples, float(distribution))
+    method, *params = distribution
+    return getattr(rng, method)(*params, size=n_samples)
+
 # TODO: - Improve WACC calculations
 def calculate_wacc(df, rf, rm, default_discount_rate):
     """
@@ -91,6 +540,25 @@ def calculate_wacc(df, rf, rm, default_discount_rate):
         print("WACC is none, falling back on default discount rate")
         return default_discount_rate
 
-    wacc = wacc if wacc >= 0.08 else 0.08   # Set WACC floor to 0.08
+    wacc = wacc if wacc >= WACC_FLOOR else WACC_FLOOR   # Set WACC floor to 0.08
 
     return wacc
+
+def calculate_wacc_batch(arrays, rf, rm, default_discount_rate):
+    """
+    Calculates WACC for many tickers at once, using the same formula and floor as calculate_wacc.
+    :param arrays: Dictionary of NumPy arrays with keys ['market_cap', 'total_debt', 'interest_expense', 'tax_rate', 'beta']
+    :param rf: Risk-free rate
+    :param rm: Market return
+    :param default_discount_rate: Kept for parity with calculate_wacc (a WACC that cannot be calculated is NaN and ends up at the floor)
+    :return: Array with the WACC per ticker
+    """
+    equity = arrays['market_cap']
+    debt = arrays['total_debt']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rdebt = arrays['interest_expense'] / debt
+        requity = rf + arrays['beta'] * (rm - rf)
+        wacc = (rdebt * (1 - arrays['tax_rate']) * (debt / (equity + debt))) + (requity * (equity / (equity + debt)))
+
+    # NaN WACC falls through to the floor, matching the comparison in calculate_wacc
+    return np.where(wacc >= WACC_FLOOR, wacc, WACC_FLOOR)
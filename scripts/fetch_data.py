@@ -1,99 +1,385 @@
-from datetime import datetime, timedelta
-from scripts.config import FETCH_CONFIG
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
+from scripts.config import FETCH_CONFIG, PRICE_WINDOW_DAYS, FETCH_WORKERS, FETCH_TIMEOUT, FETCH_RETRIES, FETCH_BACKOFF, FETCH_RATE_LIMIT
+from scripts.instrumentation import timed, stage, ticker_timer, increment
+from scripts.dcf_model import YEAR_KEY_BASE
 
 import yfinance as yf
 import pandas as pd
 import numpy as np
+import threading
+import time
 
 
-def get_financial_data(tickers, config=None):
+@timed('fetch')
+def get_financial_data(tickers, config=None, workers=None, timeout=None, retries=None, backoff=None, rate_limit=None,
+                       ticker_factory=None, cache=None, failed=None):
     """
     Fetches financial data for the given tickers using yfinance and returns a DataFrame.
+    Tickers are fetched concurrently by a bounded pool of worker threads. Every yfinance request is
+    rate limited, abandoned after a timeout and retried with exponential backoff.
+    The fetched statements of all tickers are then parsed together in one columnar pass (see parse_payloads).
     :param tickers: List of ticker symbols to fetch data for (e.g., ['AAPL', 'GOOGL']).
     :param config: Configuration dictionary defining the fields to fetch for each category.
+    :param workers: Number of tickers fetched in parallel (default FETCH_WORKERS, 1 fetches serially).
+    :param timeout: Seconds before a single request is abandoned (default FETCH_TIMEOUT, 0 for no timeout).
+    :param retries: Number of retries for a failed request (default FETCH_RETRIES).
+    :param backoff: Base delay in seconds between retries, doubled on every attempt (default FETCH_BACKOFF).
+    :param rate_limit: Maximum number of requests started per second (default FETCH_RATE_LIMIT, 0 for no limit).
+    :param ticker_factory: Callable creating the ticker object from a symbol (default yf.Ticker), e.g. a stub for offline runs.
+    :param cache: Optional ResponseCache serving fresh raw responses instead of requesting them again.
+    :param failed: Optional list collecting the tickers that still failed after the retries. Such tickers are left out
+        of the result instead of aborting the whole fetch (default None, the first failure is raised).
     :return: DataFrame with financial data indexed by ticker then year.
     """
     if config is None:
         config = FETCH_CONFIG   # Default configuration from config.py
+    workers = FETCH_WORKERS if workers is None else workers
+    timeout = FETCH_TIMEOUT if timeout is None else timeout
+    retries = FETCH_RETRIES if retries is None else retries
+    backoff = FETCH_BACKOFF if backoff is None else backoff
+    rate_limit = FETCH_RATE_LIMIT if rate_limit is None else rate_limit
+    ticker_factory = yf.Ticker if ticker_factory is None else ticker_factory
 
-    data = []
+    limiter = RateLimiter(rate_limit) if rate_limit else None
+    workers = max(1, min(workers, len(tickers)))
 
-    for ticker in tickers:
-        stock = yf.Ticker(ticker)   # Fetch the stock data using yfinance
+    # Requests run on their own pool so that a hanging call can be abandoned after the timeout.
+    # A timed out call keeps its thread busy until it returns, hence the spare threads, and the pool is shut down
+    # without waiting for such calls, so the timeout also bounds the whole fetch.
+    request_pool = ThreadPoolExecutor(max_workers=2 * workers, thread_name_prefix="yf-request")
+    try:
+        request = partial(call_with_retry, timeout=timeout, retries=retries, backoff=backoff,
+                          limiter=limiter, executor=request_pool if timeout else None)
+        fetch_payload = partial(fetch_ticker_payload, config=config, request=request, ticker_factory=ticker_factory, cache=cache)
 
-        category_cache = {}  # Cache to store fetched data for each category
-        for category in config.keys():  # Iterate through each category in the config
-            if category == 'info':  # Special case for 'info' category (not time series data)
-                category_cache['info'] = stock.info
-            else:
-                category_cache[category] = getattr(stock, category, pd.DataFrame())
-
-        # Get fiscal dates and years from the fetched data
-        years_seen, fiscal_date_by_year = get_fiscal_dates_and_years(category_cache)
-
-        if not years_seen:  # If no years were found, skip this ticker
-            years_seen = {None}
-        for year in years_seen: # Iterate through each year found in the data
-            row = {'ticker':ticker, 'year': year}   # Initialize a row with ticker and year
-            for category, fields in config.items(): # Iterate through each category and its fields
-                if category == 'info':  # Special case for 'info' category
-                    info = category_cache['info']
-                    for yf_field, col_name in fields.items():   # Iterate through each field in the 'info' category
-                        row[col_name] = info.get(yf_field)  # If the field exists in the info dictionary, assign its value to the row
-
-                elif category == 'custom':  # Custom fields that are not fetched directly from yfinance
-                    for field_key, col_name in fields.items():  # Iterate through each custom field
-                        if field_key == 'share_price' and year is not None: # Fetch share price on fiscal date
-                            fiscal_date = fiscal_date_by_year.get(year)
-                            row[col_name] = get_price_on_fiscal_date(stock, fiscal_date)
-                        else:
-                            row[col_name] = None
-
-                else:   # For the rest of the categories (financials, balancesheet, cashflow)
-                    df_cat = category_cache.get(category, pd.DataFrame())   # If the category data is not found, use an empty DataFrame
-                    if df_cat.empty:    # If the category DataFrame is empty, set all fields to None
-                        for col_name in fields.values():
-                            row[col_name] = None
-                        continue
-                    for yf_field, col_name in fields.items():   # Iterate through each field in the category
-                        if yf_field in df_cat.index:    # If the field exists in the DataFrame index
-                            value = None    # Initialize value to None
-                            for col_date, val in df_cat.loc[yf_field].items(): # Iterate through each column in the DataFrame
-                                if year == pd.to_datetime(col_date).year:   # Check if the year matches the column date
-                                    value = val # Assign the value if the year matches
-                                    break
-                            row[col_name] = value   # If a value was found, assign it to the row
-                        else:
-                            row[col_name] = None
-            data.append(row)    # Append the row to the data list
-
-
-    df = pd.DataFrame(data) # Create a DataFrame from the list of rows
+        def fetch(ticker):
+            with ticker_timer('fetch', ticker):
+                if failed is None:
+                    return fetch_payload(ticker)
+                try:
+                    return fetch_payload(ticker)
+                except Exception as e:
+                    print(f"Skipping {ticker} ({type(e).__name__}: {e})")
+                    increment('fetch_failed')
+                    failed.append(ticker)   # list.append is atomic, safe from the worker threads
+                    return None
+
+        if workers == 1:
+            payloads = [fetch(ticker) for ticker in tickers]
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="yf-ticker") as ticker_pool:
+                payloads = list(ticker_pool.map(fetch, tickers))   # map keeps the input order of the tickers
+    finally:
+        request_pool.shutdown(wait=False, cancel_futures=True)
+        if cache is not None:
+            cache.flush()   # Persist the cache index, also when a fetch failed
+
+    payloads = [payload for payload in payloads if payload is not None]    # Failed tickers were collected in `failed`
+    with stage('fetch.parse'):
+        df = parse_payloads(payloads, config)
     df.set_index(['ticker', 'year'], inplace=True)  # Set the index to be a MultiIndex with ticker and year
     df = df.sort_index(level=[0, 1], ascending=[True, False])   # Sort the DataFrame by ticker and year in descending order
     return df
 
 
-def get_price_on_fiscal_date(stock, fiscal_date):
+def fetch_ticker_payload(ticker, config=None, request=None, ticker_factory=None, cache=None):
+    """
+    Fetches the raw financial data for a single ticker: its statements, fiscal years and share prices.
+    :param ticker: Ticker symbol of the stock (e.g., 'AAPL').
+    :param config: Configuration dictionary defining the fields to fetch for each category.
+    :param request: Callable used to perform each yfinance request, e.g. call_with_retry (default calls directly).
+    :param ticker_factory: Callable creating the ticker object from a symbol (default yf.Ticker).
+    :param cache: Optional ResponseCache serving fresh raw responses instead of requesting them again.
+    :return: Dictionary with the 'ticker', the fetched 'categories', the fiscal 'years' (one row each,
+        [None] if no year was found) and the 'share_price_by_year'.
+    """
+    if config is None:
+        config = FETCH_CONFIG
+    if request is None:
+        request = _call_directly
+    if ticker_factory is None:
+        ticker_factory = yf.Ticker
+
+    stock = ticker_factory(ticker)   # Fetch the stock data using yfinance
+
+    category_cache = {}  # Cache to store fetched data for each category
+    for category in config.keys():  # Iterate through each category in the config
+        if category == 'custom':
+            continue
+        value = cache.get(ticker, category) if cache is not None else None   # Fresh response from the local cache
+        if value is None:
+            if category == 'info':  # Special case for 'info' category (not time series data)
+                value = request(getattr, stock, 'info')
+            else:
+                value = request(getattr, stock, category, pd.DataFrame())
+            if cache is not None:
+                cache.put(ticker, category, value)
+        category_cache[category] = value
+
+    # Get fiscal dates and years from the fetched data
+    years_seen, fiscal_date_by_year = get_fiscal_dates_and_years(category_cache)
+
+    share_price_by_year = {}
+    if 'share_price' in config.get('custom', {}) and years_seen:   # Fetch share prices on all fiscal dates at once
+        years = list(years_seen)
+        dates = [fiscal_date_by_year[year].isoformat() for year in years]
+        cached = cache.get(ticker, 'share_price') if cache is not None else None   # Maps fiscal date to price
+        if cached is None or not all(date in cached for date in dates):
+            prices = get_prices_on_fiscal_dates(stock, dates, request)
+            cached = dict(zip(dates, prices))
+            if cache is not None:
+                cache.put(ticker, 'share_price', cached)
+        share_price_by_year = {year: cached[date] for year, date in zip(years, dates)}
+
+    return {'ticker': ticker, 'categories': category_cache,
+            'years': list(years_seen) if years_seen else [None],   # If no years were found, keep one empty row
+            'share_price_by_year': share_price_by_year}
+
+
+def parse_payloads(payloads, config=None):
+    """
+    Parses the fetched payloads of all tickers into one row per ticker and fiscal year.
+    Columns are built as whole arrays: info fields are broadcast to the rows of their ticker, and the configured
+    fields of every statement are aligned to the rows in one pass over all tickers (see align_statements).
+    :param payloads: List of payloads from fetch_ticker_payload.
+    :param config: Configuration dictionary defining the fields to fetch for each category.
+    :return: DataFrame with ticker, year and one column per configured field.
+    """
+    if config is None:
+        config = FETCH_CONFIG
+
+    row_ticker = np.repeat(np.arange(len(payloads)), [len(payload['years']) for payload in payloads])   # Ticker position of each row
+    row_year = _object_array([year for payload in payloads for year in payload['years']])
+    columns = {'ticker': _object_array([payload['ticker'] for payload in payloads])[row_ticker], 'year': row_year}
+
+    for category, fields in config.items(): # Iterate through each category and its fields
+        if category == 'info':  # Info fields are the same for every year of a ticker
+            infos = [payload['categories']['info'] for payload in payloads]
+            for yf_field, col_name in fields.items():
+                columns[col_name] = _object_array([info.get(yf_field) for info in infos])[row_ticker]
+
+        elif category == 'custom':  # Custom fields that are not fetched directly from yfinance
+            for field_key, col_name in fields.items():
+                if field_key == 'share_price':  # Share price on fiscal date
+                    columns[col_name] = _object_array([payloads[t]['share_price_by_year'].get(year) if year is not None else None
+                                                       for t, year in zip(row_ticker, row_year)])
+                else:
+                    columns[col_name] = _object_array([None] * len(row_year))
+
+        else:   # For the rest of the categories (financials, balancesheet, cashflow)
+            statements = [payload['categories'].get(category) for payload in payloads]
+            values = align_statements(statements, list(fields), row_ticker, row_year)
+            for col_name, column in zip(fields.values(), values):
+                columns[col_name] = column
+
+    return pd.DataFrame(columns).infer_objects()    # Same dtypes as building the frame from row dictionaries
+
+
+def align_statements(statements, yf_fields, row_ticker, row_year):
+    """
+    Selects fields from the statements of many tickers and aligns them to rows of (ticker, fiscal year).
+    The statements are flattened into arrays with one entry per cell (ticker, field, year, value), the fields of all
+    tickers are looked up at once, and the first column of each fiscal year is scattered into the output.
+    :param statements: List with one statement DataFrame (or None) per ticker, fields as rows and fiscal dates as columns.
+    :param yf_fields: List of yfinance field names to select.
+    :param row_ticker: NumPy array with the ticker position of each output row.
+    :param row_year: Array with the fiscal year of each output row (None for tickers without fiscal years).
+    :return: NumPy object array of shape (fields, rows), None where a field or year is missing.
+    """
+    aligned = np.full((len(yf_fields), len(row_year)), None, dtype=object)
+
+    tickers, labels, columns, values = [], [], [], []
+    for t, df_cat in enumerate(statements):
+        if df_cat is None or df_cat.empty:    # If the category DataFrame is missing or empty, all fields stay None
+            continue
+        tickers.append(t)
+        labels.append(df_cat.index.to_numpy(dtype=object))
+        columns.append(df_cat.columns.to_numpy(dtype=object))
+        values.append(df_cat.to_numpy().ravel())   # Row-major: every column of the first field, then the next field
+    if not values:
+        return aligned
+
+    # Fiscal year of every statement column, parsing each distinct column header once
+    column_codes, headers = pd.factorize(np.concatenate(columns))
+    header_dates = [parse_column_date(header) for header in headers]
+    header_years = np.array([np.nan if pd.isna(date) else date.year for date in header_dates], dtype=float)
+
+    # Shape of every statement, repeated per statement row and then per cell
+    n_rows = np.array([len(label) for label in labels])
+    n_cols = np.array([len(column) for column in columns])
+    cols_per_row = np.repeat(n_cols, n_rows)
+    n_cells = cols_per_row.sum()
+    cell_label = np.repeat(np.arange(len(cols_per_row)), cols_per_row)     # Statement row of each cell
+    cell_start = np.repeat(np.cumsum(cols_per_row) - cols_per_row, cols_per_row)
+    col_start = np.repeat(np.repeat(np.cumsum(n_cols) - n_cols, n_rows), cols_per_row)
+    cell_column = col_start + np.arange(n_cells) - cell_start     # Position among all statement columns
+
+    cell_ticker = np.repeat(np.repeat(tickers, n_rows), cols_per_row)
+    cell_field = pd.Index(yf_fields).get_indexer_for(np.concatenate(labels))[cell_label]  # -1 if not configured
+    cell_year = header_years[column_codes[cell_column]]   # NaN for columns that are not valid dates
+    cell_value = np.concatenate(values, dtype=object)
+
+    keep = (cell_field >= 0) & ~np.isnan(cell_year)
+    cell_ticker, cell_field, cell_year, cell_value = cell_ticker[keep], cell_field[keep], cell_year[keep], cell_value[keep]
+
+    # Output row of each cell, looked up by a (ticker, year) key; rows without a fiscal year never match
+    dated_rows = np.flatnonzero([year is not None for year in row_year])
+    row_keys = pd.Index(row_ticker[dated_rows] * YEAR_KEY_BASE + row_year[dated_rows].astype(np.int64))
+    match = row_keys.get_indexer(cell_ticker * YEAR_KEY_BASE + cell_year.astype(np.int64))
+    valid = match >= 0
+    cell_row = dated_rows[match[valid]]
+    cell_field, cell_value = cell_field[valid], cell_value[valid]
+
+    # Cells are ordered by ticker, statement row and column, so the first cell per (row, field) is the first column of the year
+    _, first = np.unique(cell_row * len(yf_fields) + cell_field, return_index=True)
+    aligned[cell_field[first], cell_row[first]] = cell_value[first]
+    return aligned
+
+
+def _object_array(values):
+    """
+    Creates a one-dimensional object array from a list, also when its items are themselves sequences.
+    """
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing out the start of requests to at most `rate` per second.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: Maximum number of requests started per second.
+        """
+        self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until the next request slot is available.
+        :return: None
+        """
+        with self.lock:     # Reserve a slot while holding the lock, sleep outside of it
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def call_with_retry(func, *args, timeout=None, retries=0, backoff=0.0, limiter=None, executor=None, **kwargs):
+    """
+    Calls func(*args, **kwargs), retrying with exponential backoff when it raises or times out.
+    :param func: Callable performing the request.
+    :param timeout: Seconds to wait for the call before it is abandoned (requires an executor, None for no timeout).
+    :param retries: Number of retries after the first failed attempt.
+    :param backoff: Base delay in seconds, the delay before retry n is backoff * 2 ** n.
+    :param limiter: Optional RateLimiter acquired before every attempt.
+    :param executor: Executor running the call when a timeout is given.
+    :return: The return value of func.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        increment('http_requests')
+        try:
+            with stage('fetch.request'):
+                if executor is None:
+                    return func(*args, **kwargs)
+                return executor.submit(func, *args, **kwargs).result(timeout=timeout)
+        except Exception as e:
+            increment('http_errors')
+            if attempt == retries:  # Out of retries, surface the last error
+                raise
+            increment('http_retries')
+            delay = backoff * 2 ** attempt
+            print(f"Request failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _call_directly(func, *args, **kwargs):
+    """
+    Request function performing the call without timeout, retries or rate limiting.
+    """
+    increment('http_requests')
+    with stage('fetch.request'):
+        return func(*args, **kwargs)
+
+
+def get_price_on_fiscal_date(stock, fiscal_date, request=None):
     """
     Fetches the stock price on the fiscal date, looking 5 days before and after the fiscal date.
     :param stock: yfinance Ticker object for the stock.
     :param fiscal_date: The fiscal date to fetch the stock price for (as a string or datetime).
+    :param request: Callable used to perform the history request, e.g. call_with_retry (default calls directly).
     :return: The closing stock price on the fiscal date, or None if no data is available.
     """
-    target_date = pd.to_datetime(fiscal_date).to_pydatetime()   # Convert fiscal date to a datetime object
-    start = target_date - timedelta(days=5)
-    end = target_date + timedelta(days=5)
+    return get_prices_on_fiscal_dates(stock, [fiscal_date], request)[0]
 
-    hist = stock.history(start=start, end=end)
+def get_prices_on_fiscal_dates(stock, fiscal_dates, request=None, window_days=PRICE_WINDOW_DAYS):
+    """
+    Fetches the stock price on each fiscal date with a single price history request.
+    One contiguous history covering all fiscal dates is downloaded, and the closest trading day
+    within window_days before or after each fiscal date is resolved with an as-of lookup.
+    :param stock: yfinance Ticker object for the stock.
+    :param fiscal_dates: List of fiscal dates to fetch the stock price for (as strings or datetimes).
+    :param request: Callable used to perform the history request, e.g. call_with_retry (default calls directly).
+    :param window_days: Number of days before and after a fiscal date to look for a trading day.
+    :return: List with the closing stock price per fiscal date, None where no data is available.
+    """
+    if request is None:
+        request = _call_directly
+    if len(fiscal_dates) == 0:
+        return []
 
-    if hist.empty:  # If no historical data is available, return None
-        return None
+    targets = pd.DatetimeIndex(pd.to_datetime(list(fiscal_dates)))    # Convert fiscal dates to datetimes
+    window = pd.Timedelta(days=window_days)
+    start = (targets.min() - window).to_pydatetime()
+    end = (targets.max() + window).to_pydatetime()
 
-    hist.index = hist.index.tz_localize(None)  # Remove timezone information from the index
-    hist['diff'] = np.abs(hist.index - target_date) # Calculate the absolute difference between each date in the index and the target date
-    closest_row = hist.loc[hist['diff'].idxmin()]   # Find the row with the minimum difference (closest date to the target date)
-    return closest_row['Close']
+    hist = request(stock.history, start=start, end=end)   # One request covering every fiscal date
+
+    prices = [None] * len(targets)
+    if hist.empty:  # If no historical data is available, return None for every date
+        return prices
+
+    dates = hist.index.tz_localize(None)   # Remove timezone information from the index
+    order = np.argsort(dates.values, kind="stable")
+    dates = dates.values[order]
+    closes = hist['Close'].to_numpy()[order]
+    target_values = targets.values
+
+    # As-of lookup: the trading days just before and at/after each target date
+    right = np.searchsorted(dates, target_values, side="left")
+    left = right - 1
+    left_valid = left >= 0
+    right_valid = right < len(dates)
+    left_diff = np.where(left_valid, target_values - dates[np.clip(left, 0, None)], np.timedelta64(window_days + 1, 'D'))
+    right_diff = np.where(right_valid, dates[np.clip(right, None, len(dates) - 1)] - target_values, np.timedelta64(window_days + 1, 'D'))
+
+    use_right = right_diff < left_diff     # Ties go to the earlier trading day
+    nearest = np.where(use_right, right, left)
+    # Same window as a single-date lookup: from window_days before up to (but excluding) window_days after
+    in_window = np.where(use_right, right_diff < window, left_diff <= window)
+
+    for i in np.flatnonzero(in_window):
+        prices[i] = closes[nearest[i]]
+    return prices
+
+@lru_cache(maxsize=4096)
+def parse_column_date(col):
+    """
+    Converts a statement column header to a datetime. Headers repeat across statements and tickers, so each
+    distinct header is parsed only once.
+    :param col: Column header (e.g., a Timestamp or a date string).
+    :return: The datetime, or NaT if the header is not a valid date.
+    """
+    return pd.to_datetime(col, errors="coerce")
 
 def get_fiscal_dates_and_years(category_cache, priority=("financials", "balancesheet", "cashflow")):
     """
@@ -112,7 +398,7 @@ def get_fiscal_dates_and_years(category_cache, priority=("financials", "balances
         if df_cat.empty:    # If the category DataFrame is empty, skip to the next category
             continue
         for col in df_cat.columns:  # Iterate through each column in the category DataFrame
-            col_date = pd.to_datetime(col, errors="coerce") # Convert the column name to a datetime object, coercing errors to NaT
+            col_date = parse_column_date(col) # Convert the column name to a datetime object, NaT if it is not a date
             if pd.isna(col_date):   # If the column date is NaT (not a valid date), skip to the next column
                 continue
             year = col_date.year    # Extract the year from the column date
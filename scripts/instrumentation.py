@@ -0,0 +1,169 @@
+"""
+Stage-level timing, counters and optional profiling for a run.
+Stages are timed with the @timed decorator or the stage() context manager, per-ticker work with ticker_timer(),
+and events such as HTTP requests, cache hits and rows written are counted with increment().
+Everything is collected in this process and reported at the end of a run as a summary table or JSON lines.
+Only the SLOWEST_TICKERS slowest tickers per stage are kept, so memory stays flat however many tickers a run processes.
+"""
+from contextlib import contextmanager
+from collections import defaultdict
+from functools import wraps
+from time import perf_counter
+import tracemalloc
+import heapq
+import threading
+import cProfile
+import pstats
+import json
+import io
+
+SLOWEST_TICKERS = 5     # Number of slowest tickers kept per stage
+
+_lock = threading.Lock()
+_stages = defaultdict(lambda: [0, 0.0])     # Stage name -> [calls, total seconds]
+_tickers = defaultdict(list)                # Stage name -> min-heap of the slowest (seconds, ticker)
+_counters = defaultdict(int)                # Counter name -> value
+
+
+@contextmanager
+def stage(name):
+    """
+    Times a block of code as a stage. Stages may be nested and run concurrently in several threads.
+    :param name: Name of the stage (e.g. 'fetch', 'db.upsert')
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - start
+        with _lock:
+            _stages[name][0] += 1
+            _stages[name][1] += seconds
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a stage.
+    :param name: Name of the stage
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def ticker_timer(name, ticker):
+    """
+    Times the work on a single ticker within a stage, keeping it if it is among the slowest of the stage.
+    :param name: Name of the stage
+    :param ticker: Ticker symbol
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        seconds = perf_counter() - start
+        with _lock:
+            slowest = _tickers[name]
+            if len(slowest) < SLOWEST_TICKERS:
+                heapq.heappush(slowest, (seconds, ticker))
+            elif seconds > slowest[0][0]:   # Slower than the fastest one kept
+                heapq.heapreplace(slowest, (seconds, ticker))
+
+
+def increment(name, value=1):
+    """
+    Increments a counter.
+    :param name: Name of the counter (e.g. 'http_requests', 'cache_hits', 'rows_written')
+    :param value: Amount to add
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def reset():
+    """
+    Clears all collected timings and counters.
+    """
+    with _lock:
+        _stages.clear()
+        _tickers.clear()
+        _counters.clear()
+
+
+def summary(slowest=SLOWEST_TICKERS):
+    """
+    Returns the collected timings and counters.
+    :param slowest: Number of slowest tickers to include per stage (at most SLOWEST_TICKERS are kept)
+    :return: Dictionary with 'stages', 'counters' and 'slowest_tickers'
+    """
+    with _lock:
+        stages = {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in _stages.items()}
+        counters = dict(_counters)
+        slowest_tickers = {name: [(ticker, seconds) for seconds, ticker in heapq.nlargest(slowest, times)]
+                           for name, times in _tickers.items()}
+    return {'stages': stages, 'counters': counters, 'slowest_tickers': slowest_tickers}
+
+
+def print_summary():
+    """
+    Prints the collected timings and counters as a table.
+    """
+    report = summary()
+    print(f"{'stage':<28}{'calls':>8}{'total s':>12}{'mean ms':>12}")
+    for name, values in sorted(report['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+        print(f"{name:<28}{values['calls']:>8}{values['seconds']:>12.3f}{values['seconds'] / values['calls'] * 1000:>12.3f}")
+    for name, value in sorted(report['counters'].items()):
+        print(f"{name:<28}{value:>8}")
+    for name, tickers in report['slowest_tickers'].items():
+        print(f"slowest tickers in {name}: " + ", ".join(f"{ticker} ({seconds:.3f}s)" for ticker, seconds in tickers))
+
+
+def write_json_lines(path):
+    """
+    Appends the collected timings and counters to a file as JSON lines, one record per stage, counter and kept ticker.
+    :param path: Path of the JSON lines file
+    """
+    with _lock:
+        records = [{'type': 'stage', 'name': name, 'calls': calls, 'seconds': seconds}
+                   for name, (calls, seconds) in _stages.items()]
+        records += [{'type': 'counter', 'name': name, 'value': value} for name, value in _counters.items()]
+        records += [{'type': 'ticker', 'name': name, 'ticker': ticker, 'seconds': seconds}
+                    for name, times in _tickers.items() for seconds, ticker in sorted(times, reverse=True)]
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def profiling(enabled=True, top=20):
+    """
+    Profiles a block with cProfile (calling thread only) and tracemalloc, and prints the top functions and allocations.
+    :param enabled: If False, the block runs without profiling
+    :param top: Number of functions and allocation sites to print
+    """
+    if not enabled:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(top)
+        print(stream.getvalue())
+        print(f"Peak traced memory: {peak / 1024 / 1024:.1f} MB")
+        for statistic in snapshot.statistics("lineno")[:top]:
+            print(statistic)
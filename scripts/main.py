@@ -1,60 +1,357 @@
-from scripts.fetch_data import get_financial_data, check_ticker_data
-from scripts.db_manager import init_db, insert_data, should_fetch_data, update_last_updated, upsert_data
-from scripts.dcf_model import run_dcf
-from scripts.config import TICKERS, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS, DB_PATH, TEST_DB_PATH, REFRESH_DAYS
+from scripts.response_cache import ResponseCache
+from scripts.db_manager import init_db, get_stale_tickers, update_last_updated, update_ticker_status, upsert_data, start_run, save_results, save_simulation_results, read_financial_data, get_fingerprints, save_fingerprints, read_results
+from scripts.pipeline import run_streaming
+from scripts.server import serve
+from scripts.backtest import run_backtest
+from scripts.storage import SQLiteBackend, open_storage, export_tables
+from scripts.instrumentation import profiling, print_summary, write_json_lines, reset as reset_metrics
+from scripts.dcf_model import run_dcf, run_staged_dcf, run_monte_carlo, run_sensitivity_grid, sensitivity_frame, input_fingerprints
+from scripts.config import TICKERS, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS, DB_PATH, TEST_DB_PATH, REFRESH_DAYS, CACHE_DIR, CACHE_OFFLINE, RISK_FREE_RETURN, MARKET_RETURN, MONTE_CARLO_SAMPLES, MONTE_CARLO_DISTRIBUTIONS, SENSITIVITY_GRID, UPSERT_CHUNK_SIZE, VALUATION_WORKERS, PIPELINE_BATCH_SIZE, SERVER_HOST, SERVER_PORT, PLOT_FILE, IMPORT_TIME_BUDGET, STAGED_YEARS, HIGH_GROWTH_YEARS, FADE_YEARS, STABLE_GROWTH, RISK_FREE_CURVE, MID_YEAR, BACKTEST_HORIZONS, BACKTEST_THRESHOLD
 
 from datetime import datetime
+import argparse
+import os
+import warnings
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 
 # ----- Main -----
-def main():
+def main(argv=None):
     """
     Main function to run the DCF analysis.
     This function initializes the database, fetches financial data, runs the DCF model,
     and plots the results.
+    Timings and counters of the run are reported before plotting, so that the plot window is not measured.
+    :param argv: Command line arguments (default sys.argv), see parse_args
     """
 
-    #test()
-
+    args = parse_args(argv)
+    if args.command == 'test':
+        test()
     print(f"Starting DCF analysis at {datetime.now()}")
 
+    reset_metrics()
+    with profiling(args.profile):
+        results_df = run_command(args)
+
+    if args.metrics:
+        print_summary()
+    if args.metrics_out:
+        write_json_lines(args.metrics_out)
+    if results_df is not None and not args.no_plot:
+        plot_file = args.plot_file or (PLOT_FILE if args.headless else None)
+        plot_results(results_df, plot_file)
+
+def run_command(args):
+    """
+    Runs the command given on the command line.
+    :param args: argparse Namespace from parse_args
+    :return: DataFrame with results to plot for the 'run' command, otherwise None
+    """
     engine = init_db(DB_PATH)
+    if args.command == 'stream':   # Batches are loaded inside the pipeline, the full universe is never held in memory
+        run_id, valued, changed = run_streaming(engine, TICKERS, current_assumptions(), args.batch_size, args.resume,
+                                                ResponseCache(CACHE_DIR, offline=args.offline))
+        print(f"Finished run {run_id}: {changed} of {valued} valuations changed")
+        return None
+    if args.command == 'export':   # Copy the database into the columnar backend for analytical queries
+        target = open_storage(args.backend, args.path)
+        copied = export_tables(SQLiteBackend(engine=engine), target, args.tables)
+        target.close()
+        for table_name, rows in copied.items():
+            print(f"Exported {rows} rows of {table_name}")
+        return None
+
+    if args.command == 'backtest':     # Every stored fiscal year, not only the latest
+        run_historical_backtest(load_financial_data(engine, latest_only=False, offline=args.offline), args)
+        return None
+
+    df = load_financial_data(engine, offline=args.offline)
+    if args.command == 'serve':    # Fresh data is fetched once, then kept in memory by the server
+        serve(engine, TICKERS, args.host, args.port)
+        return None
+
+    if args.command == 'staged':
+        return run_staged(df, args)
+    if args.command == 'simulate':
+        run_simulation(engine, df, args.samples, args.seed, args.workers)
+    elif args.command == 'grid':
+        grid = {name: parse_grid_values(getattr(args, name), SENSITIVITY_GRID[name]) for name in SENSITIVITY_GRID}
+        run_grid(engine, df, grid, args.save)
+    else:
+        return run_valuation(engine, df, args.force)
+    return None
+
+def parse_args(argv=None):
+    """
+    Parses the command line.
+    Commands: 'run' (default) values every ticker and plots the results, 'simulate' runs a Monte Carlo valuation
+    'grid' evaluates a sensitivity grid of assumptions, 'stream' values large universes batch by batch,
+    'export' copies the database to another storage backend, 'serve' answers valuations over a local HTTP API
+    'staged' values every ticker with a multi-stage model and 'backtest' values every stored fiscal year.
+    :param argv: Command line arguments (default sys.argv)
+    :return: argparse Namespace
+    """
+    parser = argparse.ArgumentParser(description="DCF analysis of the tickers in config.py")
+    parser.add_argument('--workers', type=int, default=VALUATION_WORKERS, help="Worker processes for the Monte Carlo simulation")
+    parser.add_argument('--metrics', action='store_true', help="Print a table of stage timings and counters at the end of the run")
+    parser.add_argument('--metrics-out', default=None, help="Append stage timings and counters to this file as JSON lines")
+    parser.add_argument('--profile', action='store_true', help="Profile the run with cProfile and tracemalloc")
+    parser.add_argument('--headless', action='store_true', help=f"Write the plot to a file (default {PLOT_FILE}) instead of showing it")
+    parser.add_argument('--plot-file', default=None, help="Write the plot to this file (png, svg, pdf) instead of showing it")
+    parser.add_argument('--no-plot', action='store_true', help="Do not plot the results")
+    parser.add_argument('--offline', action='store_true', default=CACHE_OFFLINE,
+                        help="Use cached yfinance responses whatever their age, for reproducible runs from the cache")
+    commands = parser.add_subparsers(dest='command')
+    parser.set_defaults(force=False)
+    run = commands.add_parser('run', help="Value every ticker and plot the results (default)")
+    run.add_argument('--force', action='store_true', help="Revalue every ticker, also those whose inputs did not change")
+    staged = commands.add_parser('staged', help="Multi-stage DCF with growth fade, a risk-free curve and mid-year discounting")
+    staged.add_argument('--years', type=int, default=STAGED_YEARS, help="Number of projected years")
+    staged.add_argument('--high-growth-years', type=int, default=HIGH_GROWTH_YEARS, help="Years of GROWTH_RATE before the fade")
+    staged.add_argument('--fade-years', type=int, default=FADE_YEARS, help="Years of linear fade to the stable growth (0 for two stages)")
+    staged.add_argument('--stable-growth', type=float, default=STABLE_GROWTH, help="Growth after the fade")
+    staged.add_argument('--risk-free-curve', default=None, help="Comma separated risk-free rate per projected year (default RISK_FREE_CURVE)")
+    staged.add_argument('--mid-year', action='store_true', default=MID_YEAR, help="Discount cash flows from the middle of each year")
+    simulate = commands.add_parser('simulate', help="Monte Carlo valuation using MONTE_CARLO_DISTRIBUTIONS")
+    simulate.add_argument('--samples', type=int, default=MONTE_CARLO_SAMPLES, help="Number of samples per ticker")
+    simulate.add_argument('--seed', type=int, default=None, help="Seed for reproducible samples")
+    grid = commands.add_parser('grid', help="Sensitivity grid over growth, discount and terminal rates (default SENSITIVITY_GRID)")
+    for name in SENSITIVITY_GRID:
+        grid.add_argument(f"--{name.replace('_', '-')}", dest=name, default=None,
+                          help="Values as 'start:stop:points' or a comma separated list")
+    grid.add_argument('--save', action='store_true', help="Store the full grid in the sensitivity_grid table")
+    stream = commands.add_parser('stream', help="Value the tickers batch by batch with checkpoints, without plotting")
+    stream.add_argument('--batch-size', type=int, default=PIPELINE_BATCH_SIZE, help="Number of tickers per batch")
+    stream.add_argument('--resume', action='store_true', help="Continue the latest interrupted streaming run")
+    export = commands.add_parser('export', help="Copy the SQLite database into a columnar DuckDB file for analytics")
+    export.add_argument('--backend', default='duckdb', help="Target storage backend")
+    export.add_argument('--path', default=None, help="Target database file (default DUCKDB_PATH)")
+    export.add_argument('--tables', nargs='+', default=None, help="Tables to export (default all)")
+    server = commands.add_parser('serve', help="Keep the data in memory and answer valuations over a local HTTP API")
+    server.add_argument('--host', default=SERVER_HOST, help="Interface to listen on")
+    server.add_argument('--port', type=int, default=SERVER_PORT, help="Port to listen on")
+    backtest = commands.add_parser('backtest', help="Value every ticker as of every stored fiscal year and compare with later prices")
+    backtest.add_argument('--horizons', type=int, nargs='+', default=list(BACKTEST_HORIZONS), help="Years after each fiscal year to measure returns")
+    backtest.add_argument('--threshold', type=float, default=BACKTEST_THRESHOLD, help="Margin of safety (%%) above which a ticker is undervalued")
+    commands.add_parser('test', help="Check the program without running the DCF analysis")
+    return parser.parse_args(argv)
+
+def parse_grid_values(text, default):
+    """
+    Parses grid values given as 'start:stop:points' or as a comma separated list.
+    :param text: Command line value, or None to use the default
+    :param default: Default from SENSITIVITY_GRID, a tuple (start, stop, points) or a list of values
+    :return: NumPy array with the values
+    """
+    if text is None:
+        spec = default
+    elif ':' in text:
+        start, stop, points = text.split(':')
+        spec = (float(start), float(stop), int(points))
+    else:
+        spec = [float(value) for value in text.split(',')]
+    if isinstance(spec, tuple):
+        return np.linspace(*spec)
+    return np.asarray(spec)
 
-    # Fetches financial data if needed, else retrieves from database
-    if should_fetch_data(engine, TICKERS ,'financial_data', REFRESH_DAYS):
-        print("Fetching new data...")
-        df = get_financial_data(TICKERS)                              # Fetch financial data for the tickers
-        #insert_data(engine, df, 'financial_data')
-        upsert_data(engine, df, 'financial_data', ['ticker', 'year'])  # Upsert financial data into the financial_data table
+def load_financial_data(engine, latest_only=True, offline=False):
+    """
+    Fetches financial data for tickers that are new or outdated, and returns the latest data of all tickers from the database.
+    :param engine: SQLAlchemy engine object
+    :param latest_only: If False, return every stored fiscal year of each ticker
+    :param offline: If True, cached responses are used whatever their age (see ResponseCache)
+    :return: DataFrame with the latest financial data of each ticker, indexed by ticker then year
+    """
+    stale_tickers = get_stale_tickers(engine, TICKERS, 'financial_data', REFRESH_DAYS)
+    if stale_tickers:
+        from scripts.fetch_data import get_financial_data   # Imports yfinance, only needed when fetching
+        print(f"Fetching new data for {len(stale_tickers)} of {len(TICKERS)} tickers...")
+        fetched_df = get_financial_data(stale_tickers, cache=ResponseCache(CACHE_DIR, offline=offline))  # Fetch financial data for the stale tickers, reusing fresh cached responses
+        upsert_data(engine, fetched_df, 'financial_data', ['ticker', 'year'])  # Upsert financial data into the financial_data table
+        update_ticker_status(engine, stale_tickers, 'financial_data')   # Update last updated timestamp per ticker
         update_last_updated(engine, 'financial_data')       # Update last updated timestamp
     else:
         print("Data is up to date - fetching from database")
-        placeholders = ', '.join(['?'] * len(TICKERS))  # Create placeholders for the SQL query
-        sql = f"SELECT * FROM financial_data WHERE ticker IN ({placeholders}) ORDER BY ticker ASC, year DESC"   # SQL query to select financial data for the specified tickers
-        df = pd.read_sql(sql, engine, params=tuple(TICKERS), index_col=["ticker", "year"])  # Read data from the financial_data table
 
-    dcf_df, results_df = run_dcf(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS)    # Run DCF analysis
-    insert_data(engine, dcf_df, 'dcf_table')            # Insert DCF results into the dcf_table
-    insert_data(engine, results_df, 'results_table')    # Insert results into the results_table
+    return read_financial_data(engine, TICKERS, latest_only)   # The valuations only use the latest year of each ticker
 
-    plot_results(results_df)
+def run_valuation(engine, df, force=False):
+    """
+    Runs the DCF model for every ticker whose inputs or assumptions changed and saves the changed valuations.
+    Tickers whose input fingerprint matches their stored result reuse that result.
+    :param engine: SQLAlchemy engine object
+    :param df: DataFrame with financial data indexed by ticker then year
+    :param force: If True, revalue every ticker
+    :return: DataFrame with results indexed by ticker
+    """
+    assumptions = current_assumptions()
+    fingerprints = input_fingerprints(df, assumptions)
+    stored = get_fingerprints(engine, fingerprints.index) if not force else pd.Series(dtype=np.uint64)
+    to_value = fingerprints.index[stored.reindex(fingerprints.index).to_numpy() != fingerprints.to_numpy()]
+    reused = fingerprints.index.difference(to_value, sort=False)
+
+    run_id = start_run(engine, assumptions)
+    changed, parts = [], []
+    if len(to_value) > 0:
+        value_df = df[df.index.get_level_values('ticker').isin(to_value)]
+        dcf_df, results_df = run_dcf(value_df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS)    # Run DCF analysis
+        changed = save_results(engine, dcf_df, results_df, run_id)  # Write DCF and results of tickers whose valuation changed
+        save_fingerprints(engine, fingerprints.loc[to_value], run_id)
+        parts.append(results_df)
+    if len(reused) > 0:
+        parts.append(read_results(engine, reused))     # Stored results of the unchanged tickers
+    print(f"Saved run {run_id}: valued {len(to_value)} tickers ({len(changed)} changed), reused {len(reused)} unchanged valuations")
+    return pd.concat(parts).reindex(fingerprints.index) if parts else None
+
+def run_staged(df, args):
+    """
+    Runs the multi-stage DCF model for every ticker and prints the results.
+    The results are not saved, so that the stored single-stage valuations (and their fingerprints) stay comparable.
+    :param df: DataFrame with financial data indexed by ticker then year
+    :param args: argparse Namespace with the options of the 'staged' command
+    :return: DataFrame with results indexed by ticker
+    """
+    curve = RISK_FREE_CURVE if args.risk_free_curve is None else [float(rate) for rate in args.risk_free_curve.split(',')]
+    _, results_df = run_staged_dcf(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, args.years, args.high_growth_years,
+                                   args.fade_years, args.stable_growth, curve, args.mid_year)
+    print(results_df.drop(columns=['date']).to_string(float_format=lambda v: f"{v:.2f}"))
+    return results_df
+
+def run_historical_backtest(df, args):
+    """
+    Runs the backtest over every stored fiscal year and prints the summary and the returns per quantile.
+    :param df: DataFrame with the full financial data history indexed by ticker then year
+    :param args: argparse Namespace with the options of the 'backtest' command
+    :return: Tuple of (panel, summary, quantile returns) from run_backtest
+    """
+    panel, summary, quantiles = run_backtest(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS, args.horizons,
+                                             args.threshold)
+    print(summary.to_string(float_format=lambda v: f"{v:.3f}"))
+    print("Mean return per margin of safety quantile (1 = lowest, within each fiscal year):")
+    print(quantiles.to_string(float_format=lambda v: f"{v:.3f}"))
+    return panel, summary, quantiles
+
+def run_simulation(engine, df, samples, seed=None, workers=1):
+    """
+    Runs the Monte Carlo valuation for every ticker and saves the percentile summaries.
+    :param engine: SQLAlchemy engine object
+    :param df: DataFrame with financial data indexed by ticker then year
+    :param samples: Number of samples per ticker
+    :param seed: Seed for the random number generator
+    :param workers: Number of worker processes for the simulation
+    :return: DataFrame with the simulation summary indexed by ticker
+    """
+    simulation_df = run_monte_carlo(df, samples, MONTE_CARLO_DISTRIBUTIONS, YEARS, DISCOUNT_RATE, seed, workers)
+    run_id = start_run(engine, current_assumptions())
+    save_simulation_results(engine, simulation_df, run_id)
+    print(f"Saved simulation {run_id}")
+    print(simulation_df.drop(columns=['date']).to_string(float_format=lambda v: f"{v:.2f}"))
+    return simulation_df
+
+def run_grid(engine, df, grid, save=False):
+    """
+    Runs the sensitivity grid for every ticker, prints a summary per ticker and optionally saves the full grid.
+    :param engine: SQLAlchemy engine object
+    :param df: DataFrame with financial data indexed by ticker then year
+    :param grid: Dictionary mapping 'growth_rate', 'discount_rate', 'terminal_growth' and 'years' to their values
+    :param save: If True, store every scenario in the sensitivity_grid table
+    :return: Tuple of (cube, coords, share_price) from run_sensitivity_grid
+    """
+    cube, coords, share_price = run_sensitivity_grid(df, grid['growth_rate'], grid['discount_rate'],
+                                                     grid['terminal_growth'], grid['years'])
+    flat = cube.reshape(len(coords['ticker']), -1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)    # Tickers with missing data have all-NaN rows
+        summary = pd.DataFrame({
+            'share_price': share_price,
+            'min_price': np.nanmin(flat, axis=1),
+            'median_price': np.nanmedian(flat, axis=1),
+            'max_price': np.nanmax(flat, axis=1),
+            'share_undervalued': (flat > share_price[:, None]).mean(axis=1),   # Share of scenarios above the share price
+        }, index=pd.Index(coords['ticker'], name='ticker'))
+    print(f"{flat.shape[1]} scenarios per ticker")
+    print(summary.to_string(float_format=lambda v: f"{v:.2f}"))
+
+    if save:
+        run_id = start_run(engine, current_assumptions())
+        tickers_per_chunk = max(1, UPSERT_CHUNK_SIZE // flat.shape[1])    # Bound the size of each long table
+        for start in range(0, len(coords['ticker']), tickers_per_chunk):
+            frame = sensitivity_frame(cube, coords, share_price, slice(start, start + tickers_per_chunk))
+            upsert_data(engine, frame.assign(run_id=run_id), 'sensitivity_grid',
+                        ['run_id', 'ticker', 'growth_rate', 'discount_rate', 'terminal_growth', 'years'])
+        print(f"Saved sensitivity grid {run_id}")
+    return cube, coords, share_price
+
+def current_assumptions():
+    """
+    Returns the valuation assumptions from config.py, as stored with every run.
+    """
+    return {'growth_rate': GROWTH_RATE, 'discount_rate': DISCOUNT_RATE, 'terminal_growth': TERMINAL_GROWTH,
+            'years': YEARS, 'risk_free_return': RISK_FREE_RETURN, 'market_return': MARKET_RETURN}
 
 def test():
     """
     Test function to verify program without running the full DCF analysis.
     """
+    from scripts.benchmark import measure_import_time
+    from scripts.synthetic import make_financial_data
+    from scripts.dcf_model import calculate_dcf_schedule, growth_schedule, rate_curve
     print("Running test function...")
-    # Write test here
+    failures = []
+
+    # Parity: the staged model with a single stage and a flat risk-free curve reproduces run_dcf
+    df = make_financial_data(1000)
+    dcf_df, results_df = run_dcf(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS)
+    staged_dcf_df, staged_results_df = run_staged_dcf(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS)
+    for name, expected, actual in [('dcf', dcf_df, staged_dcf_df), ('results', results_df.drop(columns=['date']),
+                                                                     staged_results_df.drop(columns=['date']))]:
+        if not np.allclose(expected.to_numpy(dtype=float), actual.to_numpy(dtype=float), rtol=1e-12, equal_nan=True):
+            failures.append(f"Single-stage {name} differs from run_dcf")
+
+    # Three stages, a discount curve and mid-year discounting against a year by year loop
+    fcf, shares, terminal_growth = np.array([100.0, -50.0]), np.array([10.0, 20.0]), 0.02
+    growth = growth_schedule(8, 0.10, 3, 2, 0.04)     # Fade 0.10 -> 0.08 -> 0.06 -> 0.04
+    rates = np.array([[0.08, 0.09, 0.10, 0.10, 0.11, 0.11, 0.12, 0.12], [0.10] * 8])
+    for mid_year in (False, True):
+        price = calculate_dcf_schedule(fcf, shares, growth, rates, terminal_growth, mid_year)[-1]
+        for i in range(len(fcf)):
+            value, flow, factor = 0.0, fcf[i], 1.0
+            for year in range(8):
+                flow *= 1 + growth[year]
+                factor /= 1 + rates[i, year]
+                value += flow * factor * ((1 + rates[i, year]) ** 0.5 if mid_year else 1)
+            value += flow * (1 + terminal_growth) / (rates[i, -1] - terminal_growth) * factor
+            if not np.isclose(price[i], value / shares[i], rtol=1e-12):
+                failures.append(f"Staged price of ticker {i} (mid_year={mid_year}) differs from the loop: {price[i]} != {value / shares[i]}")
+    if not np.allclose(growth, [0.10, 0.10, 0.10, 0.08, 0.06, 0.04, 0.04, 0.04]) or not np.allclose(rate_curve([0.02, 0.03], 3), [0.02, 0.03, 0.03]):
+        failures.append("Unexpected growth schedule or rate curve")
+
+    # Startup: the cached path must not pay for yfinance or matplotlib, which are imported when fetching or plotting
+    seconds, modules = measure_import_time('scripts.main')
+    print(f"import scripts.main: {seconds:.3f} s (budget {IMPORT_TIME_BUDGET:.3f} s)")
+    if seconds > IMPORT_TIME_BUDGET:
+        failures.append(f"Importing scripts.main took {seconds:.3f} s, over the budget of {IMPORT_TIME_BUDGET} s")
+    for heavy in ('yfinance', 'matplotlib'):
+        if heavy in modules:
+            failures.append(f"Importing scripts.main imports {heavy} ({modules[heavy]:.3f} s)")
+
+    for failure in failures:
+        print(f"FAILED: {failure}")
     print("Exiting test function...")
-    exit()
+    exit(1 if failures else 0)
 
-def plot_results(df):
+def plot_results(df, plot_file=None):
     """
     Plots the results of the DCF analysis.
     :param df: DataFrame containing the results with columns ['share_price', 'estimated_price', 'margin_of_safety']
+    :param plot_file: If given, render the plot to this file with the non-interactive Agg backend instead of showing it
     """
+    import matplotlib   # Imported here, runs that do not plot never load it
+    if plot_file is not None:
+        matplotlib.use("Agg")   # No display needed, e.g. in cron jobs
+    import matplotlib.pyplot as plt
+
     x = np.arange(len(df.index))  # Numerical positions for tickers
     width = 0.35
 
@@ -84,7 +381,13 @@ def plot_results(df):
     plt.legend()
 
     plt.tight_layout()
-    plt.show()
+    if plot_file is None:
+        plt.show()
+    else:
+        os.makedirs(os.path.dirname(plot_file) or '.', exist_ok=True)     # data/ is not part of a fresh checkout
+        plt.savefig(plot_file)
+        plt.close()
+        print(f"Saved plot to {plot_file}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
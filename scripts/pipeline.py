@@ -0,0 +1,112 @@
+"""
+Streaming pipeline from fetch to database for very large ticker universes.
+Tickers flow through the stages in batches (fetch -> DCF -> chunked writes), so memory is bounded by the batch size
+rather than the size of the universe. Every written batch is checkpointed, and an interrupted run resumes
+with the tickers it had not completed yet. A ticker that cannot be fetched is skipped and recorded in ticker_status
+under the 'fetch_failed' category, so it does not abort its batch (and the resumed run) again.
+"""
+from scripts.db_manager import (get_stale_tickers, update_ticker_status, update_last_updated, upsert_data,
+                                read_financial_data, start_run, save_results, start_pipeline_run,
+                                get_unfinished_pipeline_run, get_completed_tickers, mark_completed,
+                                finish_pipeline_run)
+from scripts.dcf_model import run_dcf
+from scripts.config import GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS, REFRESH_DAYS, PIPELINE_BATCH_SIZE
+
+
+def run_streaming(engine, tickers, assumptions, batch_size=None, resume=False, cache=None):
+    """
+    Values the tickers batch by batch, checkpointing every batch that has been written.
+    :param engine: SQLAlchemy engine object
+    :param tickers: List of tickers to value
+    :param assumptions: Assumptions stored with the run (see start_run)
+    :param batch_size: Number of tickers per batch (default PIPELINE_BATCH_SIZE)
+    :param resume: If True, continue the latest unfinished streaming run instead of starting a new one
+    :param cache: Optional ResponseCache used when fetching
+    :return: Tuple of (run id, number of tickers valued, number of valuations that changed)
+    """
+    batch_size = PIPELINE_BATCH_SIZE if batch_size is None else batch_size
+
+    run_id = get_unfinished_pipeline_run(engine) if resume else None
+    if run_id is None:
+        run_id = start_run(engine, assumptions)
+        start_pipeline_run(engine, run_id)
+    else:
+        completed = get_completed_tickers(engine, run_id)
+        print(f"Resuming run {run_id}: {len(completed)} tickers already completed")
+        tickers = [ticker for ticker in tickers if ticker not in completed]
+
+    batches = iter_batches(tickers, batch_size)
+    data = stream_financial_data(engine, batches, cache)
+    valuations = stream_valuations(data)
+    valued, changed = write_valuations(engine, valuations, run_id)
+
+    finish_pipeline_run(engine, run_id)
+    return run_id, valued, changed
+
+
+def iter_batches(tickers, batch_size):
+    """
+    Yields consecutive batches of tickers.
+    :param tickers: List of tickers
+    :param batch_size: Number of tickers per batch
+    :return: Generator of lists of tickers
+    """
+    for start in range(0, len(tickers), batch_size):
+        yield tickers[start:start + batch_size]
+
+
+def stream_financial_data(engine, batches, cache=None):
+    """
+    Fetches stale tickers of each batch into the database and yields the batch's financial data.
+    Tickers that fail to fetch are skipped and recorded as 'fetch_failed' in ticker_status.
+    :param engine: SQLAlchemy engine object
+    :param batches: Iterable of lists of tickers
+    :param cache: Optional ResponseCache used when fetching
+    :return: Generator of (tickers, DataFrame with the latest financial data of each ticker, indexed by ticker then year)
+    """
+    for batch in batches:
+        stale_tickers = get_stale_tickers(engine, batch, 'financial_data', REFRESH_DAYS)
+        if stale_tickers:
+            from scripts.fetch_data import get_financial_data   # Imports yfinance, only needed when fetching
+            print(f"Fetching new data for {len(stale_tickers)} of {len(batch)} tickers...")
+            failed = []
+            fetched_df = get_financial_data(stale_tickers, cache=cache, failed=failed)
+            fetched_df = fetched_df[fetched_df.index.get_level_values('year').notna()]    # Tickers without fiscal years have no rows to store
+            upsert_data(engine, fetched_df, 'financial_data', ['ticker', 'year'])
+            update_ticker_status(engine, [ticker for ticker in stale_tickers if ticker not in failed], 'financial_data')
+            update_ticker_status(engine, failed, 'fetch_failed')    # Last failure; still stale, so a later run retries them
+            update_last_updated(engine, 'financial_data')
+        yield batch, read_financial_data(engine, batch, latest_only=True)
+
+
+def stream_valuations(data):
+    """
+    Runs the DCF model on each batch of financial data.
+    :param data: Iterable of (tickers, DataFrame with financial data)
+    :return: Generator of (tickers, DCF DataFrame, results DataFrame)
+    """
+    for batch, df in data:
+        if df.empty:    # No stored data for any ticker of the batch
+            yield batch, None, None
+            continue
+        dcf_df, results_df = run_dcf(df, GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS)
+        yield batch, dcf_df, results_df
+
+
+def write_valuations(engine, valuations, run_id):
+    """
+    Writes each batch of valuations and checkpoints its tickers as completed.
+    :param engine: SQLAlchemy engine object
+    :param valuations: Iterable of (tickers, DCF DataFrame, results DataFrame)
+    :param run_id: Id of the run
+    :return: Tuple of (number of tickers valued, number of valuations that changed)
+    """
+    valued = 0
+    changed = 0
+    for batch, dcf_df, results_df in valuations:
+        if results_df is not None:
+            changed += len(save_results(engine, dcf_df, results_df, run_id))
+            valued += len(results_df)
+        mark_completed(engine, run_id, batch)   # Checkpoint after the batch has been written
+        print(f"Completed {valued} tickers ({changed} changed)")
+    return valued, changed
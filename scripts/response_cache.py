@@ -0,0 +1,207 @@
+"""
+Local on-disk cache for raw yfinance responses.
+Statement frames are stored as Parquet files and info dictionaries as JSON files, one file per (ticker, category).
+An index file keeps track of when each entry was written and last used, so that stale entries
+can be refetched and the least recently used entries can be evicted when the cache grows too large.
+"""
+from scripts.config import CACHE_TTL_DAYS, CACHE_MAX_MB, CACHE_OFFLINE
+from scripts.instrumentation import increment
+
+from urllib.parse import quote
+import pandas as pd
+import threading
+import json
+import time
+import os
+
+INDEX_FILE = "index.json"
+EVICT_TARGET = 0.9  # Eviction frees space down to this fraction of the size bound, so a full cache is not sorted on every put
+
+
+class ResponseCache:
+    """
+    Thread-safe cache of yfinance payloads keyed by (ticker, category) with per-category TTLs and LRU eviction.
+    """
+
+    def __init__(self, cache_dir, ttl_days=None, max_mb=None, offline=None):
+        """
+        :param cache_dir: Directory to store the cached files in (created if missing).
+        :param ttl_days: Dictionary mapping category to the number of days an entry stays fresh (default CACHE_TTL_DAYS).
+        :param max_mb: Maximum total size of the cache in megabytes before LRU eviction (default CACHE_MAX_MB).
+        :param offline: If True, entries never expire, which allows reproducible runs from the cache alone (default CACHE_OFFLINE).
+        """
+        self.cache_dir = cache_dir
+        self.ttl_days = CACHE_TTL_DAYS if ttl_days is None else ttl_days
+        self.max_bytes = (CACHE_MAX_MB if max_mb is None else max_mb) * 1024 * 1024
+        self.offline = CACHE_OFFLINE if offline is None else offline
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()     # key -> {'file', 'category', 'created', 'accessed', 'size'}
+        self.total_bytes = sum(entry['size'] for entry in self.index.values())    # Kept up to date with the index
+        if self.total_bytes > self.max_bytes:   # The bound may have been lowered since the cache was written
+            self._evict()
+            self.flush()
+
+    def get(self, ticker, category):
+        """
+        Returns the cached payload for a ticker and category, or None if it is missing or stale.
+        :param ticker: Ticker symbol (e.g., 'AAPL').
+        :param category: Category of the payload (e.g., 'info', 'cashflow').
+        :return: DataFrame or dictionary, or None on a cache miss.
+        """
+        key = self._key(ticker, category)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or self._is_stale(entry):
+                self.misses += 1
+                increment('cache_misses')
+                return None
+            path = os.path.join(self.cache_dir, entry['file'])
+
+        try:
+            value = self._read(path)
+        except (OSError, ValueError):   # Missing (e.g. evicted meanwhile) or corrupt file, treat as a miss
+            with self.lock:
+                self._drop(key)
+                self.misses += 1
+            increment('cache_misses')
+            return None
+
+        with self.lock:
+            entry['accessed'] = time.time()
+            self.hits += 1
+        increment('cache_hits')
+        return value
+
+    def put(self, ticker, category, value):
+        """
+        Stores a payload for a ticker and category, evicting least recently used entries if the cache is full.
+        :param ticker: Ticker symbol (e.g., 'AAPL').
+        :param category: Category of the payload (e.g., 'info', 'cashflow').
+        :param value: DataFrame (statements) or dictionary (info) to store.
+        :return: None
+        """
+        key = self._key(ticker, category)
+        extension = "json" if isinstance(value, dict) else "parquet"
+        file_name = f"{key}.{extension}"
+        path = os.path.join(self.cache_dir, file_name)
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        self._write(tmp_path, value)
+
+        with self.lock:
+            os.replace(tmp_path, path)  # Atomic swap so readers never see a partial file
+            now = time.time()
+            self._drop(key)     # A replaced entry no longer counts towards the size
+            self.index[key] = {'file': file_name, 'category': category, 'created': now, 'accessed': now,
+                               'size': os.path.getsize(path)}
+            self.total_bytes += self.index[key]['size']
+            self._evict()
+
+    def flush(self):
+        """
+        Writes the cache index to disk, persisting access times for LRU eviction across runs.
+        :return: None
+        """
+        with self.lock:
+            path = os.path.join(self.cache_dir, INDEX_FILE)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, path)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        :return: None
+        """
+        with self.lock:
+            for entry in self.index.values():
+                self._remove_file(entry['file'])
+            self.index = {}
+            self.total_bytes = 0
+        self.flush()
+
+    def _is_stale(self, entry):
+        """
+        Checks whether an entry is older than the TTL of its category.
+        """
+        if self.offline:
+            return False
+        ttl_days = self.ttl_days.get(entry['category'])
+        if ttl_days is None:    # No TTL configured for the category, the entry never expires
+            return False
+        return time.time() - entry['created'] > ttl_days * 86400
+
+    def _evict(self):
+        """
+        Removes least recently used entries once the cache exceeds its size bound, until it is within
+        EVICT_TARGET of the bound. Caller holds the lock.
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]['accessed']):
+            self._remove_file(entry['file'])
+            self._drop(key)
+            if self.total_bytes <= self.max_bytes * EVICT_TARGET:
+                break
+
+    def _drop(self, key):
+        """
+        Removes an entry from the index (not its file) and from the total size, if it exists. Caller holds the lock.
+        """
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry['size']
+
+    def _remove_file(self, file_name):
+        """
+        Removes a cached file, ignoring files that are already gone.
+        """
+        try:
+            os.remove(os.path.join(self.cache_dir, file_name))
+        except FileNotFoundError:
+            pass
+
+    def _load_index(self):
+        """
+        Loads the cache index from disk, starting empty if it is missing or unreadable.
+        """
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _key(ticker, category):
+        """
+        Builds a file-system safe key for a ticker and category.
+        """
+        return f"{quote(ticker, safe='')}__{category}"
+
+    @staticmethod
+    def _write(path, value):
+        """
+        Writes a payload, dictionaries as JSON and DataFrames as Parquet.
+        Statement frames have dates as columns, so they are stored transposed to get string column names.
+        """
+        if isinstance(value, dict):
+            with open(path, "w") as f:
+                json.dump(value, f, default=str)    # Non JSON values (e.g. timestamps) are stored as strings
+        else:
+            value.T.to_parquet(path)
+
+    @staticmethod
+    def _read(path):
+        """
+        Reads a payload written by _write.
+        """
+        if path.endswith(".json"):
+            with open(path) as f:
+                return json.load(f)
+        return pd.read_parquet(path).T
@@ -0,0 +1,259 @@
+"""
+Long-running valuation service with a local HTTP API.
+The latest financial data of every ticker is read once into compact NumPy arrays and kept in memory, so a request
+only values the requested tickers. Valuations are memoized per (ticker, assumptions) until the data is reloaded.
+Start it with `python -m scripts.main serve` and query it with e.g.
+    curl "http://127.0.0.1:8050/value?ticker=CAST.ST&growth_rate=0.04&terminal_growth=0.02"
+    curl "http://127.0.0.1:8050/wacc?ticker=CAST.ST&ticker=SAGA-B.ST&risk_free_return=0.03"
+    curl -X POST "http://127.0.0.1:8050/reload"
+"""
+from scripts.db_manager import read_financial_arrays
+from scripts.dcf_model import value_arrays, calculate_wacc_batch, INPUT_COLUMNS
+from scripts.instrumentation import timed, increment
+from scripts.config import (GROWTH_RATE, DISCOUNT_RATE, TERMINAL_GROWTH, YEARS, RISK_FREE_RETURN, MARKET_RETURN,
+                            SERVER_HOST, SERVER_PORT, SERVER_CACHE_SIZE, SERVER_MAX_YEARS)
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from functools import lru_cache
+import json
+import math
+import numpy as np
+
+# Assumptions a request may override. The discount rate is not one of them: the valuation discounts at the WACC
+# (floored at WACC_FLOOR), so DISCOUNT_RATE is passed on unchanged, as in run_dcf
+DEFAULT_ASSUMPTIONS = {'growth_rate': GROWTH_RATE, 'terminal_growth': TERMINAL_GROWTH, 'years': YEARS,
+                       'risk_free_return': RISK_FREE_RETURN, 'market_return': MARKET_RETURN}
+
+
+class ValuationStore:
+    """
+    In-memory store of the latest financial data per ticker, with memoized valuations.
+    Safe to use from several request threads: reload() swaps the arrays and the memo in one assignment.
+    """
+
+    def __init__(self, engine, tickers, cache_size=SERVER_CACHE_SIZE):
+        """
+        :param engine: SQLAlchemy engine object
+        :param tickers: List of tickers to serve
+        :param cache_size: Number of memoized (ticker, assumptions) valuations
+        """
+        self.engine = engine
+        self.tickers = list(tickers)
+        self.cache_size = cache_size
+        self.reload()
+
+    @timed('server.reload')
+    def reload(self):
+        """
+        Reads the latest financial data of every ticker from the database and clears the memoized valuations.
+        :return: Number of tickers loaded
+        """
+        tickers, arrays = read_financial_arrays(self.engine, self.tickers, latest_only=True)
+        arrays = {column: arrays[column].astype(float) for column in INPUT_COLUMNS}
+        positions = {ticker: position for position, ticker in enumerate(tickers)}
+        value = lru_cache(maxsize=self.cache_size)(lambda ticker, key: self._value(arrays, positions[ticker], key))
+        self._state = (positions, arrays, value)     # Replaced as a whole, requests in flight keep the old state
+        print(f"Loaded {len(positions)} tickers")
+        return len(positions)
+
+    def __len__(self):
+        """
+        :return: Number of tickers loaded
+        """
+        return len(self._state[0])
+
+    def value(self, tickers, assumptions):
+        """
+        Values the given tickers under the given assumptions.
+        :param tickers: List of tickers
+        :param assumptions: Dictionary of assumptions, missing keys default to DEFAULT_ASSUMPTIONS
+        :return: Tuple of (dictionary mapping each ticker to its share price, WACC, estimated price and margin of safety,
+            cache statistics of the memo)
+        """
+        key = assumption_key(assumptions)
+        positions, _, memo = self._state
+        self._check_tickers(tickers, positions)
+        results = {ticker: memo(ticker, key) for ticker in tickers}
+        increment('server.valuations', len(tickers))
+        return results, memo.cache_info()
+
+    def wacc(self, tickers, assumptions):
+        """
+        Calculates the WACC of the given tickers.
+        :param tickers: List of tickers
+        :param assumptions: Dictionary of assumptions, only 'risk_free_return' and 'market_return' are used
+        :return: Dictionary mapping each ticker to its WACC
+        """
+        assumptions = dict(assumption_key(assumptions))     # Validated like the assumptions of value()
+        positions, arrays, _ = self._state
+        self._check_tickers(tickers, positions)
+        rows = np.array([positions[ticker] for ticker in tickers], dtype=np.int64)
+        wacc = calculate_wacc_batch({column: values[rows] for column, values in arrays.items()},
+                                    assumptions['risk_free_return'], assumptions['market_return'], DISCOUNT_RATE)
+        return {ticker: _number(value) for ticker, value in zip(tickers, wacc)}
+
+    @staticmethod
+    def _value(arrays, position, key):
+        """
+        Values a single ticker, the uncached part of value().
+        """
+        assumptions = dict(key)
+        row = {column: values[position:position + 1] for column, values in arrays.items()}
+        values = value_arrays(row, assumptions['growth_rate'], DISCOUNT_RATE,
+                              assumptions['terminal_growth'], int(assumptions['years']),
+                              assumptions['risk_free_return'], assumptions['market_return'])
+        return {'share_price': _number(row['share_price'][0]), 'wacc': _number(values['wacc'][0]),
+                'estimated_price': _number(values['estimated_price'][0]),
+                'margin_of_safety': _number(values['margin_of_safety'][0])}
+
+    @staticmethod
+    def _check_tickers(tickers, positions):
+        """
+        Raises KeyError naming the tickers that are not loaded.
+        """
+        missing = [ticker for ticker in tickers if ticker not in positions]
+        if missing:
+            raise KeyError(f"Unknown tickers: {', '.join(missing)}")
+
+
+def assumption_key(assumptions):
+    """
+    Returns a hashable key of the assumptions, with defaults filled in, for memoization.
+    Raises ValueError for unknown names, values that are not finite numbers and years outside 1..SERVER_MAX_YEARS.
+    :param assumptions: Dictionary of assumption overrides, numbers or numeric strings
+    :return: Tuple of (name, value) pairs in the order of DEFAULT_ASSUMPTIONS
+    """
+    unknown = set(assumptions) - set(DEFAULT_ASSUMPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown assumptions: {', '.join(sorted(unknown))}")
+    key = tuple((name, _assumption(name, assumptions.get(name, default))) for name, default in DEFAULT_ASSUMPTIONS.items())
+    years = dict(key)['years']
+    if years < 1 or years > SERVER_MAX_YEARS or years != int(years):
+        raise ValueError(f"years must be an integer from 1 to {SERVER_MAX_YEARS}")
+    return key
+
+
+def _assumption(name, value):
+    """
+    Converts an assumption from a query string or a JSON body to a float, raising ValueError unless it is a finite number.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):    # null, lists and objects in a JSON body
+        raise ValueError(f"{name} must be a number")
+    try:
+        value = float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number") from None
+    if not math.isfinite(value):
+        raise ValueError(f"{name} must be a finite number")
+    return value
+
+
+class ValuationHandler(BaseHTTPRequestHandler):
+    """
+    HTTP endpoints of the valuation service, all answering with JSON:
+    GET /value and /wacc with repeated ticker= parameters and optional assumption overrides (or POST with a JSON body
+    {"tickers": [...], "assumptions": {...}}), GET /health, and POST /reload to re-read the database.
+    """
+    store = None    # ValuationStore, set by make_server()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        tickers = query.pop('ticker', [])
+        assumptions = {name: values[-1] for name, values in query.items()}
+        self._dispatch(url.path, tickers, assumptions)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send(400, {'error': "Body is not valid JSON"})
+            return
+        if not isinstance(body, dict):
+            self._send(400, {'error': "Body must be a JSON object"})
+            return
+        tickers, assumptions = body.get('tickers', []), body.get('assumptions', {})
+        if not isinstance(tickers, list) or not all(isinstance(ticker, str) for ticker in tickers):
+            self._send(400, {'error': "tickers must be a list of strings"})     # A string would be iterated per character
+            return
+        if not isinstance(assumptions, dict):
+            self._send(400, {'error': "assumptions must be a JSON object"})
+            return
+        self._dispatch(url.path, tickers, assumptions)
+
+    def _dispatch(self, path, tickers, assumptions):
+        """
+        Runs the endpoint of a path and sends its result, or an error with status 400 or 404.
+        """
+        try:
+            if path == '/value':
+                results, info = self.store.value(tickers, assumptions)
+                self._send(200, {'assumptions': dict(assumption_key(assumptions)), 'results': results,
+                                 'cache': {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}})
+            elif path == '/wacc':
+                self._send(200, {'results': self.store.wacc(tickers, assumptions)})
+            elif path == '/health':
+                self._send(200, {'status': 'ok', 'tickers': len(self.store)})
+            elif path == '/reload' and self.command == 'POST':
+                self._send(200, {'tickers': self.store.reload()})
+            else:
+                self._send(404, {'error': f"Unknown endpoint: {self.command} {path}"})
+        except KeyError as e:
+            self._send(404, {'error': e.args[0]})
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+
+    def _send(self, status, payload):
+        """
+        Sends a JSON response.
+        """
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return    # Requests are counted in the metrics instead of logged per line
+
+
+def make_server(store, host=SERVER_HOST, port=SERVER_PORT):
+    """
+    Creates the HTTP server of a store, without starting it.
+    :param store: ValuationStore
+    :param host: Interface to listen on
+    :param port: Port to listen on (0 picks a free port)
+    :return: ThreadingHTTPServer
+    """
+    handler = type('StoreHandler', (ValuationHandler,), {'store': store})    # Handler class bound to this store
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(engine, tickers, host=SERVER_HOST, port=SERVER_PORT):
+    """
+    Loads the tickers and answers requests until interrupted with Ctrl+C.
+    :param engine: SQLAlchemy engine object
+    :param tickers: List of tickers to serve
+    :param host: Interface to listen on
+    :param port: Port to listen on
+    """
+    server = make_server(ValuationStore(engine, tickers), host, port)
+    print(f"Serving valuations on http://{server.server_address[0]}:{server.server_address[1]} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping server")
+    finally:
+        server.server_close()
+
+
+def _number(value):
+    """
+    Converts a NumPy float to a JSON number, with NaN and infinity as null.
+    """
+    value = float(value)
+    return value if math.isfinite(value) else None
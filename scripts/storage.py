@@ -0,0 +1,236 @@
+"""
+Storage backends for exporting and analysing the DCF data.
+The program itself always runs on the SQLite database of db_manager. SQLiteBackend wraps that database, and
+DuckDBBackend keeps copies of its tables in an embedded, columnar DuckDB file (`main export`), which scans and
+aggregates many years of financial_data and dcf_table history much faster than SQLite's row store.
+Both run locally without a server and accept the same SQL (with ? placeholders) in query().
+The interface only holds what export_tables and the storage benchmark need: reading, writing and querying tables.
+"""
+from scripts.db_manager import init_db, upsert_data, insert_data, get_table
+from scripts.config import DB_PATH, DUCKDB_PATH, UPSERT_CHUNK_SIZE
+from scripts.instrumentation import timed, increment
+
+from abc import ABC, abstractmethod
+from sqlalchemy import inspect
+import pandas as pd
+import os
+
+
+class StorageBackend(ABC):
+    """
+    Interface of a storage backend. Frames are written with their key columns in the index, like upsert_data.
+    """
+
+    @abstractmethod
+    def upsert(self, df, table_name, keys):
+        """
+        Inserts the rows of a DataFrame, updating rows whose keys already exist.
+        :param df: DataFrame to write, indexed by the key columns
+        :param table_name: Name of the table
+        :param keys: List of key columns
+        :return: Number of rows written
+        """
+
+    @abstractmethod
+    def insert(self, df, table_name):
+        """
+        Replaces a table with the rows of a DataFrame.
+        :param df: DataFrame to write, its index is written as columns
+        :param table_name: Name of the table
+        :return: None
+        """
+
+    @abstractmethod
+    def query(self, sql, params=None):
+        """
+        Runs a SQL query.
+        :param sql: SQL with ? placeholders
+        :param params: Sequence of parameters
+        :return: DataFrame with the result
+        """
+
+    @abstractmethod
+    def read_table(self, table_name, chunk_size=None):
+        """
+        Reads a whole table.
+        :param table_name: Name of the table
+        :param chunk_size: Number of rows per chunk (default the whole table in one chunk)
+        :return: Iterator of DataFrames
+        """
+
+    @abstractmethod
+    def table_names(self):
+        """
+        :return: List of table names
+        """
+
+    @abstractmethod
+    def primary_key(self, table_name):
+        """
+        :param table_name: Name of the table
+        :return: List of the primary key columns, empty if the table has none
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Releases the connection to the database.
+        """
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    The SQLite database of db_manager that the program runs on, the source of exports.
+    """
+
+    def __init__(self, path=DB_PATH, engine=None):
+        """
+        :param path: Path to the SQLite database file
+        :param engine: Existing SQLAlchemy engine to use instead of opening the path
+        """
+        self.engine = init_db(path) if engine is None else engine
+
+    def upsert(self, df, table_name, keys):
+        return upsert_data(self.engine, df, table_name, keys)
+
+    def insert(self, df, table_name):
+        insert_data(self.engine, df, table_name)
+
+    @timed('storage.query')
+    def query(self, sql, params=None):
+        return pd.read_sql(sql, self.engine, params=tuple(params or ()))
+
+    def read_table(self, table_name, chunk_size=None):
+        if chunk_size is None:
+            return iter([pd.read_sql_table(table_name, self.engine)])
+        return pd.read_sql_table(table_name, self.engine, chunksize=chunk_size)
+
+    def table_names(self):
+        return inspect(self.engine).get_table_names()
+
+    def primary_key(self, table_name):
+        return [column.name for column in get_table(self.engine, table_name).primary_key.columns]
+
+    def close(self):
+        self.engine.dispose()
+
+
+class DuckDBBackend(StorageBackend):
+    """
+    Columnar backend in an embedded DuckDB file. Tables are created on first write with the key columns as primary key.
+    """
+
+    def __init__(self, path=DUCKDB_PATH):
+        """
+        :param path: Path to the DuckDB database file (':memory:' for an in-memory database)
+        """
+        try:
+            import duckdb   # Optional dependency, only needed for this backend
+        except ImportError as e:
+            raise ImportError("The DuckDB storage backend requires the duckdb package (pip install duckdb)") from e
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = duckdb.connect(path)
+
+    @timed('storage.upsert')
+    def upsert(self, df, table_name, keys):
+        df = df.reset_index().drop_duplicates(keys, keep='last')   # A key may only be written once per statement
+        self._create_table(df, table_name, keys)
+        columns = ", ".join(f'"{c}"' for c in df.columns)
+        self.conn.register("incoming", df)
+        try:    # INSERT OR REPLACE updates the inserted columns of rows whose keys exist, like upsert_data
+            self.conn.execute(f'INSERT OR REPLACE INTO "{table_name}" ({columns}) SELECT {columns} FROM incoming')
+        finally:
+            self.conn.unregister("incoming")
+        increment('rows_written', len(df))
+        return len(df)
+
+    @timed('storage.insert')
+    def insert(self, df, table_name):
+        self.conn.register("incoming", df.reset_index())
+        try:
+            self.conn.execute(f'CREATE OR REPLACE TABLE "{table_name}" AS SELECT * FROM incoming')
+        finally:
+            self.conn.unregister("incoming")
+        increment('rows_written', len(df))
+
+    @timed('storage.query')
+    def query(self, sql, params=None):
+        return self.conn.execute(sql, list(params or ())).df()
+
+    def read_table(self, table_name, chunk_size=None):
+        return iter([self.conn.execute(f'SELECT * FROM "{table_name}"').df()])
+
+    def table_names(self):
+        return [row[0] for row in self.conn.execute("SELECT table_name FROM duckdb_tables() ORDER BY table_name").fetchall()]
+
+    def primary_key(self, table_name):
+        row = self.conn.execute("""SELECT constraint_column_names FROM duckdb_constraints()
+                                   WHERE table_name = ? AND constraint_type = 'PRIMARY KEY'""", [table_name]).fetchone()
+        return [] if row is None else list(row[0])
+
+    def close(self):
+        self.conn.close()
+
+    def _create_table(self, df, table_name, keys):
+        """
+        Creates a table with columns typed after the DataFrame's dtypes and the keys as primary key, if it does not exist.
+        """
+        columns = ", ".join(f'"{name}" {_duckdb_type(dtype)}' for name, dtype in df.dtypes.items())
+        key_list = ", ".join(f'"{k}"' for k in keys)
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({columns}, PRIMARY KEY ({key_list}))')
+
+
+def _duckdb_type(dtype):
+    """
+    Returns the DuckDB column type for a pandas dtype.
+    """
+    if pd.api.types.is_bool_dtype(dtype):
+        return "BOOLEAN"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "BIGINT"
+    if pd.api.types.is_float_dtype(dtype):
+        return "DOUBLE"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "TIMESTAMP"
+    return "VARCHAR"
+
+
+def open_storage(backend, path=None):
+    """
+    Opens a storage backend, e.g. the target of an export.
+    :param backend: 'sqlite' or 'duckdb'
+    :param path: Path of the database file (default DB_PATH or DUCKDB_PATH)
+    :return: StorageBackend
+    """
+    if backend == 'sqlite':
+        return SQLiteBackend(DB_PATH if path is None else path)
+    if backend == 'duckdb':
+        return DuckDBBackend(DUCKDB_PATH if path is None else path)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def export_tables(source, target, tables=None, chunk_size=None):
+    """
+    Copies tables from one backend to another, e.g. the SQLite database into a DuckDB file for analytics.
+    Tables with a primary key are upserted in chunks, so exporting again only updates the copied rows.
+    :param source: StorageBackend to read from
+    :param target: StorageBackend to write to
+    :param tables: List of table names (default every table of the source)
+    :param chunk_size: Number of rows read and written at a time (default UPSERT_CHUNK_SIZE * 10)
+    :return: Dictionary mapping each table name to the number of rows copied
+    """
+    chunk_size = UPSERT_CHUNK_SIZE * 10 if chunk_size is None else chunk_size
+    copied = {}
+    for table_name in (source.table_names() if tables is None else tables):
+        keys = source.primary_key(table_name)
+        copied[table_name] = 0
+        if not keys:    # Without keys the table can only be replaced as a whole
+            df = pd.concat(list(source.read_table(table_name)))
+            target.insert(df.set_index(df.columns[0]), table_name)
+            copied[table_name] = len(df)
+            continue
+        for chunk in source.read_table(table_name, chunk_size):
+            target.upsert(chunk.set_index(keys), table_name, keys)
+            copied[table_name] += len(chunk)
+    return copied
@@ -0,0 +1,123 @@
+"""
+Synthetic data for offline runs and benchmarks.
+make_financial_data creates frames shaped like the financial_data table (see data/data.csv), and FakeTicker
+stands in for yf.Ticker with statements laid out like yfinance's (fields as rows, fiscal dates as columns).
+"""
+from scripts.config import FETCH_CONFIG
+
+from zlib import crc32
+import pandas as pd
+import numpy as np
+import threading
+import time
+
+LAST_FISCAL_YEAR = 2024
+
+
+def make_financial_data(n_tickers, years_per_ticker=4, seed=0):
+    """
+    Creates a synthetic DataFrame shaped like the financial_data table.
+    :param n_tickers: Number of tickers
+    :param years_per_ticker: Number of fiscal years per ticker
+    :param seed: Seed for the random number generator
+    :return: DataFrame indexed by ticker then year (descending), with the columns of data/data.csv
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = n_tickers * years_per_ticker
+    tickers = np.repeat(make_tickers(n_tickers), years_per_ticker)
+    years = np.tile(np.arange(LAST_FISCAL_YEAR, LAST_FISCAL_YEAR - years_per_ticker, -1), n_tickers)
+    shares_outstanding = np.repeat(rng.uniform(1e7, 2e9, n_tickers), years_per_ticker)  # Info fields are the same every year
+    share_price = rng.uniform(5, 500, n_rows)
+    df = pd.DataFrame({
+        'fcf': rng.normal(2e9, 3e9, n_rows),
+        'total_debt': rng.uniform(1e8, 1.5e11, n_rows),
+        'tax_rate': rng.uniform(0.1, 0.3, n_rows),
+        'interest_expense': rng.uniform(1e7, 6e9, n_rows),
+        'shares_outstanding': shares_outstanding,
+        'market_cap': np.repeat(share_price[::years_per_ticker], years_per_ticker) * shares_outstanding,
+        'beta': np.repeat(rng.uniform(0.3, 2.0, n_tickers), years_per_ticker),
+        'share_price': share_price,
+    }, index=pd.MultiIndex.from_arrays([tickers, years], names=['ticker', 'year']))
+    return df
+
+
+def make_tickers(n_tickers):
+    """
+    Creates synthetic ticker symbols.
+    :param n_tickers: Number of tickers
+    :return: List of ticker symbols
+    """
+    return [f"SYN{i:06d}.ST" for i in range(n_tickers)]
+
+
+class FakeTicker:
+    """
+    Offline stand-in for yf.Ticker with deterministic data per symbol and optional latency per request.
+    """
+    requests = 0    # Number of requests made by all fake tickers
+    lock = threading.Lock()
+
+    def __init__(self, ticker, latency=0.0, years=4, config=None):
+        """
+        :param ticker: Ticker symbol
+        :param latency: Seconds each request sleeps, to emulate network latency
+        :param years: Number of fiscal years in the statements
+        :param config: Fetch configuration defining the statement fields (default FETCH_CONFIG)
+        """
+        self.ticker = ticker
+        self.latency = latency
+        self.config = FETCH_CONFIG if config is None else config
+        self.seed = crc32(ticker.encode())  # Stable across processes, unlike hash()
+        self.fiscal_dates = [pd.Timestamp(f"{LAST_FISCAL_YEAR - i}-12-31") for i in range(years)]
+
+    @property
+    def info(self):
+        self._request()
+        rng = np.random.default_rng(self.seed)
+        return {'impliedSharesOutstanding': float(rng.uniform(1e7, 2e9)), 'marketCap': float(rng.uniform(1e8, 1e12)),
+                'beta': float(rng.uniform(0.3, 2.0)), 'currency': 'SEK'}
+
+    @property
+    def cashflow(self):
+        return self._statement('cashflow', ['Operating Cash Flow', 'Capital Expenditure'])
+
+    @property
+    def balancesheet(self):
+        return self._statement('balancesheet', ['Total Assets', 'Total Debt'])
+
+    @property
+    def financials(self):
+        return self._statement('financials', ['Total Revenue', 'Net Income'])
+
+    def history(self, start=None, end=None):
+        """
+        Returns daily closing prices on business days between start and end, like yf.Ticker.history.
+        """
+        self._request()
+        dates = pd.date_range(pd.Timestamp(start).normalize(), pd.Timestamp(end), freq='B', tz='Europe/Stockholm', inclusive='left')
+        rng = np.random.default_rng(self.seed)
+        base = rng.uniform(5, 500)
+        days = (dates.tz_localize(None) - pd.Timestamp("2000-01-01")).days.to_numpy()
+        close = base * (1 + 0.2 * np.sin(days / 90.0))   # Deterministic in the date, independent of the requested range
+        return pd.DataFrame({'Close': close}, index=dates)
+
+    def _statement(self, category, extra_fields):
+        """
+        Builds a statement with the configured fields plus some extra rows, fiscal dates as columns.
+        """
+        self._request()
+        fields = list(self.config.get(category, {})) + extra_fields
+        rng = np.random.default_rng([self.seed, crc32(category.encode())])
+        values = rng.normal(1e9, 5e8, (len(fields), len(self.fiscal_dates)))
+        rates = [i for i, field in enumerate(fields) if 'Rate' in field]   # e.g. 'Tax Rate For Calcs'
+        values[rates] = rng.uniform(0.1, 0.3, (len(rates), len(self.fiscal_dates)))
+        return pd.DataFrame(values, index=fields, columns=self.fiscal_dates)
+
+    def _request(self):
+        """
+        Counts a request and sleeps for the configured latency.
+        """
+        with FakeTicker.lock:
+            FakeTicker.requests += 1
+        if self.latency:
+            time.sleep(self.latency)